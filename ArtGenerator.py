@@ -3,12 +3,1013 @@ Felipe S. Mezzarana 23.02.2023
 """
 
 import sys
-from PIL import Image, ImageDraw, ImageFilter
-import random
+from PIL import Image, ImageDraw, ImageFilter, ImageChops
 import numpy as np
 import re
 import os
+import io
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque, OrderedDict
+import itertools
+import copy
+import bisect
+import math
+import struct
+import zlib
+import hashlib
+import threading
+import queue
+import json
+import contextlib
+import functools
+import tracemalloc
+import time
+
+# Version of the module, it must change whenever a seed gives a different image (ArtCatalog stores it)
+__version__ = '1.0'
+
+
+def _rasterize_lines(lines:list, img_size:tuple):
+    """Return the pixels of a group of 1 pixel width lines, computed in a single batched operation
+    * Reproduces the Bresenham algorithm used by ImageDraw.line (endpoints included),
+    so the output is pixel-identical to drawing the lines one by one
+    * Pixels are returned as two int arrays (x, y), pixels outside the image are dropped
+    
+    Keyword arguments:
+    lines -- list of (x1,y1,x2,y2) int coordinates
+    img_size -- 2-d tuple with (x,y) in pixels
+    """
+    
+    x1, y1, x2, y2 = np.asarray(lines, dtype = np.int64).reshape(-1,4).T
+    dx, dy = np.abs(x2 - x1), np.abs(y2 - y1)
+    step_x, step_y = np.where(x2 >= x1, 1, -1), np.where(y2 >= y1, 1, -1)
+    major = np.maximum(dx, dy)
+    
+    # Range of steps (endpoints included) that may fall inside the image, so long lines
+    # that mostly lie outside the canvas don't generate useless pixels
+    first, last = np.zeros_like(major), major.copy()
+    for start, step, delta, length in [(x1, step_x, dx, img_size[0]), (y1, step_y, dy, img_size[1])]:
+        # Offsets along this axis that stay inside [0, length-1]
+        low = np.where(step > 0, -start, start - (length-1))
+        high = np.where(step > 0, length-1 - start, start)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            ratio = major / delta
+            first = np.maximum(first, np.where(delta > 0, np.floor((low - 1)*ratio), np.where(low <= 0, 0, major + 1)))
+            last = np.minimum(last, np.where(delta > 0, np.ceil((high + 1)*ratio), np.where(high >= 0, major, -1)))
+    first, last = first.astype(np.int64), last.astype(np.int64)
+    n_points = np.maximum(last - first + 1, 0)
+    
+    # Index of each point inside its line, for all lines at once
+    line_idx = np.repeat(np.arange(len(n_points)), n_points)
+    i = np.arange(n_points.sum()) - np.repeat(np.cumsum(n_points) - n_points, n_points) + first[line_idx]
+    dx, dy, major = dx[line_idx], dy[line_idx], np.maximum(major[line_idx], 1)
+    # Closed form of Bresenham: the minor axis moves floor(i*minor/major + 1/2)
+    x_major = dx > dy
+    offset_x = np.where(x_major, i, (2*i*dx + major) // (2*major))
+    offset_y = np.where(x_major, (2*i*dy + major) // (2*major), i)
+    x = x1[line_idx] + step_x[line_idx]*offset_x
+    y = y1[line_idx] + step_y[line_idx]*offset_y
+    
+    # Clip to image
+    inside = (x >= 0) & (x < img_size[0]) & (y >= 0) & (y < img_size[1])
+    return x[inside], y[inside]
+
+
+def _fill_polygon(img, xy, color:tuple, chunk_size:int = 1 << 22):
+    """Fill a polygon in img with the even-odd rule, in place
+    * Scanline fill without sorting: every crossing of an edge with a row toggles the pixels on its right,
+    the toggles are counted with bincount and a cumulative sum along the rows gives the parity
+    * Cost is linear in the number of edge/row crossings, so it stays fast for huge self-intersecting
+    polygons (10^5 vertices), where ImageDraw.polygon becomes quadratic
+    * The pixel at each crossing is filled too, like ImageDraw.polygon, the output differs from it
+    only by a few pixels on the boundary
+
+    Keyword arguments:
+    img -- RGB image, changed in place
+    xy -- flat sequence or (n,2) array of vertices [x0,y0,x1,y1,...]
+    color -- RGB color
+    chunk_size -- maximum number of crossings computed at once (bounds the temporary memory)
+    """
+
+    x0, y0 = np.asarray(xy, dtype = np.float64).reshape(-1,2).T
+    # Only the bounding box of the polygon (clipped to the image) is copied to an array
+    left, right = max(int(np.floor(x0.min())), 0), min(int(np.floor(x0.max())) + 1, img.size[0])
+    top, bottom = max(int(np.ceil(y0.min())), 0), min(int(np.floor(y0.max())) + 1, img.size[1])
+    if left >= right or top >= bottom:
+        return
+    width, height = right - left, bottom - top
+
+    # Edges (the last vertex is joined to the first), horizontal ones never cross a row
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+    keep = y0 != y1
+    x0, y0, x1, y1 = x0[keep], y0[keep], x1[keep], y1[keep]
+    slope = (x1 - x0)/(y1 - y0)
+    # Rows r crossed by each edge: min(y0,y1) <= r < max(y0,y1)
+    first = np.maximum(np.ceil(np.minimum(y0, y1)), top).astype(np.int64)
+    crossings = np.maximum(np.minimum(np.ceil(np.maximum(y0, y1)), bottom).astype(np.int64) - first, 0)
+
+    # One extra column receives the toggles on the right of the box
+    toggles = np.zeros(height*(width + 1), dtype = np.int64)
+    boundary = np.zeros(height*(width + 1), dtype = bool)
+    ends = np.cumsum(crossings)
+    start = 0
+    while start < len(crossings):
+        # Edges whose crossings fit in chunk_size (at least one edge)
+        stop = max(int(np.searchsorted(ends, (ends[start - 1] if start > 0 else 0) + chunk_size, 'right')), start + 1)
+        counts = crossings[start:stop]
+        edge = np.repeat(np.arange(start, stop), counts)
+        rows = first[edge] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        x = x0[edge] + (rows - y0[edge])*slope[edge]
+        index = (rows - top)*(width + 1)
+        toggles += np.bincount(index + np.clip(np.ceil(x).astype(np.int64) - left, 0, width), minlength = len(toggles))
+        # Crossings outside the box are sent to the extra column
+        column = np.floor(x + 0.5).astype(np.int64) - left
+        boundary[index + np.where((column < 0) | (column > width), width, column)] = True
+        start = stop
+
+    inside = np.cumsum(toggles.reshape(height, width + 1)[:, :width], axis = 1) & 1
+    inside = inside.astype(bool) | boundary.reshape(height, width + 1)[:, :width]
+    region = np.array(img.crop((left, top, right, bottom)))
+    region[inside] = color
+    img.paste(Image.fromarray(region), (left, top))
+
+
+# Render quality tiers, name -> settings used by DisplayList.render
+# * scale -- resolution scale of the output image
+# * supersample -- the commands are rasterized at supersample times the size and reduced once (box filter)
+# * skip_blur -- smooth_lines filters with a blur factor up to it are not applied (None applies all)
+QUALITY_TIERS = {'draft': {'scale': 0.5, 'supersample': 1, 'skip_blur': float('inf')},
+                 'standard': {'scale': 1, 'supersample': 1, 'skip_blur': None},
+                 'final': {'scale': 1, 'supersample': 3, 'skip_blur': 1}}
+
+
+class DisplayList():
+    """A resolution-independent list of drawing commands
+    * Has the same drawing methods as ImageDraw used by ArtGenerator, but instead of
+    rasterizing, each call is stored as a compact command with coordinates normalized to 0-1
+    * render(size) rasterizes all commands once, at any resolution
+    """
+    
+    
+    def __init__(self, img_size:tuple, bg_color:tuple):
+        """Keyword arguments:
+        img_size -- 2-d tuple with (x,y) in pixels of the recorded coordinates
+        bg_color -- RGB background color
+        """
+        self.img_size = tuple(img_size)
+        self.bg_color = bg_color
+        # List of (method name, normalized coordinates, args, kwargs)
+        self.commands = []
+        
+        
+    def _add(self, name:str, xy, *args, **kwargs):
+        """Store a command, x coordinates are divided by width and y coordinates by height"""
+        xy = [float(v) for v in xy]
+        xy = tuple(v/self.img_size[i % 2] for i, v in enumerate(xy))
+        self.commands.append((name, xy, args, kwargs))
+
+
+    def line(self, xy, fill = None, width:int = 1, joint = None):
+        self._add('line', xy, fill = fill, width = width, joint = joint)
+        
+    def rectangle(self, xy, fill = None, outline = None, width:int = 1):
+        self._add('rectangle', xy, fill = fill, outline = outline, width = width)
+        
+    def chord(self, xy, start, end, fill = None, outline = None, width:int = 1):
+        self._add('chord', xy, start, end, fill = fill, outline = outline, width = width)
+        
+    def arc(self, xy, start, end, fill = None, width:int = 1):
+        self._add('arc', xy, start, end, fill = fill, width = width)
+        
+    def ellipse(self, xy, fill = None, outline = None, width:int = 1):
+        self._add('ellipse', xy, fill = fill, outline = outline, width = width)
+        
+    def polygon(self, xy, fill = None, outline = None, width:int = 1):
+        self._add('polygon', xy, fill = fill, outline = outline, width = width)
+        
+    def point(self, xy, fill = None):
+        self._add('point', xy, fill = fill)
+        
+    def regular_polygon(self, bounding_circle, n_sides:int, rotation:float = 0, fill = None, outline = None):
+        # The radius is stored relative to the image diagonal scale (geometric mean of width and height)
+        x, y, radius = bounding_circle
+        self._add('regular_polygon', (x, y), radius/(self.img_size[0]*self.img_size[1])**0.5, n_sides, rotation,
+                  fill = fill, outline = outline)
+        
+    def smooth(self, blur_factor:float, backend:str = 'pil'):
+        """Store the SMOOTH_MORE + BoxBlur filters used by ArtGenerator.smooth_lines"""
+        self.commands.append(('smooth', (), (blur_factor, backend), {}))
+        
+        
+    def render(self, size:tuple = None, quality:str = 'standard'):
+        """Return a new image with all commands rasterized
+        * Lengths that are not coordinates (widths, radius and blur) are scaled by the
+        geometric mean of the width and height scale factors
+        * quality (see QUALITY_TIERS), costs measured at 1920x1080, where 'standard' takes ~0.15s (mostly smoothing):
+        'draft' -- half the width and height and no smoothing, ~3ms, for previews
+        'standard' -- the image drawn by ArtGenerator without record mode
+        'final' -- rasterized at 3x (9x the pixels) and reduced once with a box filter, which anti-aliases
+        the edges instead of the slight smoothing (blur factor <= 1) of smooth_lines, ~0.05s. Stronger blurs
+        are kept as an effect and filtered at 3x, up to ~2s. Points are drawn as 3x3 squares so they keep
+        their intensity
+        
+        Keyword arguments:
+        size -- 2-d tuple with (x,y) in pixels (default recorded img_size), scaled by the quality tier
+        quality -- 'draft', 'standard' or 'final'
+        """
+        
+        if quality not in QUALITY_TIERS:
+            raise Exception('quality must be ' + ', '.join(QUALITY_TIERS))
+        tier = QUALITY_TIERS[quality]
+        if size == None:
+            size = self.img_size
+        factor = tier['scale']*tier['supersample']
+        size = (max(1, round(size[0]*factor)), max(1, round(size[1]*factor)))
+        img = self._render_box(size, (0, 0, size[0], size[1]), tier['skip_blur'], tier['supersample'])
+        if tier['supersample'] > 1:
+            img = img.reduce(tier['supersample'])
+        return img
+    
+    
+    def _halo(self, size:tuple):
+        """Return how many pixels around a tile can change its pixels through the smooth filters at size"""
+        scale = (size[0]*size[1]/(self.img_size[0]*self.img_size[1]))**0.5
+        # SMOOTH_MORE reaches 2 pixels and BoxBlur int(radius) + 1
+        return sum(2 + int(args[0]*scale) + 1 for name, xy, args, kwargs in self.commands if name == 'smooth')
+    
+    
+    def _render_box(self, size:tuple, box:tuple, skip_blur:float = None, point_size:int = 1):
+        """Return the pixels inside box (x1,y1,x2,y2) of the image rasterized at size
+        * The commands are drawn in a region extended by the smooth filters reach (clipped to the image),
+        so the pixels are the same as rendering the whole image and cropping it
+        * smooth commands with a blur factor up to skip_blur are not applied, points are drawn as
+        point_size x point_size squares
+        """
+        
+        scale = (size[0]*size[1]/(self.img_size[0]*self.img_size[1]))**0.5
+        halo = self._halo(size) if box != (0, 0, size[0], size[1]) else 0
+        left, top = max(box[0] - halo, 0), max(box[1] - halo, 0)
+        right, bottom = min(box[2] + halo, size[0]), min(box[3] + halo, size[1])
+        img = Image.new('RGB', (right - left, bottom - top), color = self.bg_color)
+        draw = ImageDraw.Draw(img)
+        for name, xy, args, kwargs in self.commands:
+            if name == 'smooth':
+                if skip_blur != None and args[0] <= skip_blur:
+                    continue
+                img = _smooth(img, args[0]*scale, *args[1:])
+                draw = ImageDraw.Draw(img)
+                continue
+            # Rounding removes float errors, so rendering at the recorded size gives the same pixels
+            xy = [round(v*size[i % 2], 6) for i, v in enumerate(xy)]
+            if name == 'regular_polygon':
+                # Vertices computed as ImageDraw.regular_polygon does, in image coordinates
+                radius = args[0]*(size[0]*size[1])**0.5
+                vertices = ImageDraw._compute_regular_polygon_vertices((xy[0], xy[1], radius), *args[1:])
+                name, xy, args = 'polygon', [v for vertex in vertices for v in vertex], ()
+            if name in ['line', 'point', 'arc', 'chord', 'ellipse', 'rectangle', 'polygon']:
+                # ImageDraw truncates these coordinates to int, done before the tile offset
+                # so the pixels of a tile don't depend on its position
+                xy = [int(v) for v in xy]
+            xy = [v - (left, top)[i % 2] for i, v in enumerate(xy)]
+            if name == 'point' and point_size > 1:
+                # Every offset of the square, for all points at once
+                offsets = np.stack(np.meshgrid(range(point_size), range(point_size)), axis = -1).reshape(-1, 2)
+                xy = (np.asarray(xy).reshape(-1, 1, 2) + offsets).ravel().tolist()
+            if 'width' in kwargs:
+                kwargs = dict(kwargs, width = max(1, int(round(kwargs['width']*scale))))
+            getattr(draw, name)(xy, *args, **kwargs)
+        if (left, top, right, bottom) != tuple(box):
+            img = img.crop((box[0] - left, box[1] - top, box[2] - left, box[3] - top))
+        return img
+    
+    
+    def render_tiled(self, size:tuple, path:str, tile_size:int = 1024, workers:int = None):
+        """Rasterize the commands tile by tile and write them to path, returns path
+        * Memory is bounded by the tile size instead of the image size (a band of tiles for .png),
+        so very large canvases (e.g. 30000x20000) can be rendered
+        * Tiles are rendered in parallel by a thread pool, each tile is drawn with a margin for the
+        smooth filters, so the result is the same as render(size)
+        * path .npy -- a memory-mapped uint8 array (height, width, 3), open it with np.load(path, mmap_mode='r')
+        * path .png -- streamed row by row to a png file, compressed while the tiles are rendered
+        
+        Keyword arguments:
+        size -- 2-d tuple with (x,y) in pixels
+        path -- output file, .npy or .png
+        tile_size -- side of the square tiles in pixels
+        workers -- number of threads (default os.cpu_count())
+        """
+        
+        size = tuple(size)
+        if not path.endswith(('.npy', '.png')):
+            raise Exception('path must be a .npy or .png file')
+        if workers == None:
+            workers = os.cpu_count() or 1
+        bands = [[(x, y, min(x + tile_size, size[0]), min(y + tile_size, size[1]))
+                  for x in range(0, size[0], tile_size)] for y in range(0, size[1], tile_size)]
+        
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            if path.endswith('.npy'):
+                pixels = np.lib.format.open_memmap(path, mode = 'w+', dtype = np.uint8, shape = (size[1], size[0], 3))
+                
+                def render_tile(box):
+                    pixels[box[1]:box[3], box[0]:box[2]] = np.asarray(self._render_box(size, box))
+                
+                for future in [executor.submit(render_tile, box) for band in bands for box in band]:
+                    future.result()
+                pixels.flush()
+                del pixels
+            else:
+                with open(path, 'wb') as file:
+                    writer = _PngStreamWriter(file, size)
+                    # The tiles of the next band are rendered while the current one is compressed
+                    pending = [executor.submit(self._render_box, size, box) for box in bands[0]]
+                    for i in range(len(bands)):
+                        tiles = [np.asarray(future.result()) for future in pending]
+                        if i + 1 < len(bands):
+                            pending = [executor.submit(self._render_box, size, box) for box in bands[i + 1]]
+                        writer.write_rows(np.concatenate(tiles, axis = 1))
+                        del tiles
+                    writer.close()
+        return path
+
+
+class _PngStreamWriter():
+    """Write an RGB png file row by row, without holding the whole image in memory"""
+    
+    
+    def __init__(self, file, size:tuple, compress_level:int = 6):
+        self.file = file
+        self.compressor = zlib.compressobj(compress_level)
+        file.write(b'\x89PNG\r\n\x1a\n')
+        # 8 bits per channel, color type 2 (RGB), no interlace
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', size[0], size[1], 8, 2, 0, 0, 0))
+    
+    
+    def _chunk(self, kind:bytes, data:bytes):
+        self.file.write(struct.pack('>I', len(data)) + kind + data)
+        self.file.write(struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+    
+    
+    def write_rows(self, rows):
+        """Compress and write rows, a uint8 array (n_rows, width, 3)"""
+        # Each row starts with its filter type, 0 (none)
+        data = np.concatenate([np.zeros((rows.shape[0], 1), dtype = np.uint8), rows.reshape(rows.shape[0], -1)], axis = 1)
+        compressed = self.compressor.compress(data.tobytes())
+        if compressed:
+            self._chunk(b'IDAT', compressed)
+    
+    
+    def close(self):
+        self._chunk(b'IDAT', self.compressor.flush())
+        self._chunk(b'IEND', b'')
+
+
+def _peak_memory(reset:bool = False):
+    """Return the peak resident memory of the process in bytes (VmHWM), or None if /proc is not available (Linux only)
+    * Unlike tracemalloc it includes the pixel buffers allocated by Pillow
+    
+    Keyword arguments:
+    reset -- if True the peak is reset to the current resident memory after being read
+    """
+    try:
+        with open('/proc/self/status') as file:
+            peak = int(re.search(r'VmHWM:\s+(\d+) kB', file.read()).group(1))*1024
+        if reset:
+            with open('/proc/self/clear_refs', 'w') as file:
+                file.write('5')
+        return peak
+    except (OSError, AttributeError):
+        return None
+
+
+def _box_blur_kernel(radius:float):
+    """Return the 1-d kernel of ImageFilter.BoxBlur(radius), the pixels at the edges
+    of the window have the fractional part of the radius as weight
+    """
+    full = int(radius)
+    kernel = np.ones(2*full + 3)
+    kernel[0] = kernel[-1] = radius - full
+    return kernel/(2*radius + 1)
+
+
+def _fused_smooth(img, blur_factor:float, strip_height:int = 32):
+    """Apply SMOOTH_MORE followed by BoxBlur(blur_factor) in a single pass, in place
+    * SMOOTH_MORE is (5x5 box + 4 * 3x3 box + 39 * center pixel)/100, it is computed from horizontal
+    3 and 5 pixels sums and then blurred by the two 1-d passes of the box blur, rounded like the PIL passes
+    * The image is processed in horizontal strips that are pasted back into img, every operation writes
+    into buffers allocated once, so the temporary memory is a few strips (~12 MB at 3840 pixels wide)
+    regardless of the image height
+    * Differs from the two filters by at most 2 levels, from the rounding of the PIL passes
+    
+    Keyword arguments:
+    img -- RGB image, changed in place
+    blur_factor -- BoxBlur radius
+    strip_height -- number of rows processed at once
+    """
+    
+    width, height = img.size
+    if width < 5 or height < 5:
+        img.paste(img.filter(ImageFilter.SMOOTH_MORE).filter(ImageFilter.BoxBlur(blur_factor)))
+        return
+    box = _box_blur_kernel(blur_factor).astype(np.float32)
+    radius = len(box)//2
+    # Rows of the original image needed around the strip: box blur radius + 2 for the 5x5 sum
+    halo = radius + 2
+    strip_height = max(min(strip_height, height), halo)
+    
+    # Buffers reused by every strip
+    source = np.empty((strip_height + 2*halo, width, 3), dtype = np.float32)
+    sums = np.empty((strip_height + 2*halo, width - 4, 3), dtype = np.float32)
+    smooth = np.empty((strip_height + 2*radius, width + 2*radius, 3), dtype = np.float32)
+    horizontal = np.empty((strip_height + 2*radius, width, 3), dtype = np.float32)
+    scratch = np.empty((strip_height + 2*halo, width, 3), dtype = np.float32)
+    result = np.empty((strip_height, width, 3), dtype = np.float32)
+    pixels = np.empty((strip_height, width, 3), dtype = np.uint8)
+    # Original rows above the current strip, already overwritten in img
+    previous = np.empty((halo, width, 3), dtype = np.float32)
+    
+    for y0 in range(0, height, strip_height):
+        y1 = min(y0 + strip_height, height)
+        rows = y1 - y0
+        top, bottom = max(y0 - halo, 0), min(y1 + halo, height)
+        src = source[:bottom - top]
+        np.copyto(src, np.asarray(img.crop((0, top, width, bottom))))
+        if y0 > 0:
+            src[:y0 - top] = previous[halo - (y0 - top):]
+        if y1 < height:
+            np.copyto(previous, src[y1 - halo - top:y1 - top])
+        
+        # SMOOTH_MORE on the rows needed by the box blur, the 2 pixels border is copied unchanged like PIL
+        first, last = max(y0 - radius, 0), min(y1 + radius, height)
+        smoothed = smooth[:last - first, radius:radius + width]
+        np.copyto(smoothed, src[first - top:last - top])
+        inner_first, inner_last = max(first, 2), min(last, height - 2)
+        n = inner_last - inner_first
+        if n > 0:
+            inner = smoothed[inner_first - first:inner_last - first, 2:width - 2]
+            around = src[inner_first - 2 - top:inner_last + 2 - top]
+            np.multiply(around[2:n + 2, 2:width - 2], 0.39, out = inner)
+            part = scratch[:n, :width - 4]
+            # Horizontal 3 pixels sums, then 5 pixels sums in the same buffer
+            s = sums[:n + 4]
+            np.add(around[:, 1:width - 3], around[:, 2:width - 2], out = s)
+            s += around[:, 3:width - 1]
+            for j in range(1, 4):
+                np.multiply(s[j:j + n], 0.04, out = part)
+                inner += part
+            s += around[:, :width - 4]
+            s += around[:, 4:]
+            for j in range(5):
+                np.multiply(s[j:j + n], 0.01, out = part)
+                inner += part
+            inner += 0.5
+            np.floor(inner, out = inner)
+        
+        # Box blur, horizontal pass on the smoothed rows with the edges extended
+        smooth[:last - first, :radius] = smoothed[:, :1]
+        smooth[:last - first, radius + width:] = smoothed[:, -1:]
+        # Rows above and below the image are copies of the first and last row
+        offset = first - (y0 - radius)
+        h = horizontal[offset:offset + last - first]
+        part = scratch[:last - first]
+        np.multiply(smooth[:last - first, :width], box[0], out = h)
+        for j in range(1, len(box)):
+            np.multiply(smooth[:last - first, j:j + width], box[j], out = part)
+            h += part
+        h += 0.5
+        np.floor(h, out = h)
+        horizontal[:offset] = h[:1]
+        horizontal[offset + last - first:rows + 2*radius] = h[-1:]
+        
+        # Vertical pass
+        out = result[:rows]
+        part = scratch[:rows]
+        np.multiply(horizontal[:rows], box[0], out = out)
+        for j in range(1, len(box)):
+            np.multiply(horizontal[j:j + rows], box[j], out = part)
+            out += part
+        out += 0.5
+        np.clip(out, 0, 255, out = out)
+        np.copyto(pixels[:rows], out, casting = 'unsafe')
+        img.paste(Image.fromarray(pixels[:rows]), (0, y0))
+
+
+def _smooth(img, blur_factor:float, backend:str = 'pil'):
+    """Return img with SMOOTH_MORE + BoxBlur(blur_factor) applied
+    
+    Keyword arguments:
+    img -- RGB image, changed in place with backend 'numpy'
+    blur_factor -- BoxBlur radius
+    backend -- 'pil' (two filter passes, each one allocates a new image) or 'numpy' (fused single pass over
+    strips, in place)
+    """
+    if backend == 'numpy':
+        _fused_smooth(img, blur_factor)
+        return img
+    img = img.filter(ImageFilter.SMOOTH_MORE)
+    return img.filter(ImageFilter.BoxBlur(blur_factor))
+
+
+def _shard_dir(directory:str, name:str, shard:str = None):
+    """Return the subdirectory of directory where the file name is stored (created if needed)
+    
+    Keyword arguments:
+    directory -- base directory
+    name -- file name
+    shard -- None (no subdirectory), 'date' (one per day, YYYY-MM-DD) or 'hash' (256 subdirectories
+    named after the first 2 hex chars of the name hash)
+    """
+    if shard == 'date':
+        directory = os.path.join(directory, datetime.today().strftime('%Y-%m-%d'))
+    elif shard == 'hash':
+        directory = os.path.join(directory, hashlib.sha1(name.encode()).hexdigest()[:2])
+    elif shard != None:
+        raise Exception("Arg shard must be None, 'date' or 'hash'")
+    os.makedirs(directory, exist_ok = True)
+    return directory
+
+
+def _create_exclusive(path:str, data:bytes):
+    """Create path and write data to it, raises FileExistsError if path already exists
+    * The file is created atomically (O_EXCL), so two processes can never get the same path
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o644)
+    with os.fdopen(fd, 'wb') as file:
+        file.write(data)
+
+
+def _write_unique(data:bytes, directory:str = '.', naming:str = 'counter', shard:str = None, extension:str = 'jpeg'):
+    """Write data to a new file with an unique name in directory and return its path
+    * Never lists the directory, the cost is constant regardless of the number of files in it
+    * naming 'counter' gives the names 'img <date>', 'img1 <date>', 'img2 <date>'...
+    the last counter of each day is kept in the hidden file .img_counter of the directory, it is only a hint,
+    the exclusive creation of the file is what prevents two workers from using the same name
+    * naming 'hash' names the file after the sha1 of its content, the same image is only stored once
+    
+    Keyword arguments:
+    data -- encoded image
+    directory -- base directory (default workdir)
+    naming -- 'counter' or 'hash'
+    shard -- None, 'date' or 'hash', see _shard_dir
+    extension -- file extension without dot
+    """
+    
+    if naming == 'hash':
+        name = hashlib.sha1(data).hexdigest() + '.' + extension
+        path = os.path.join(_shard_dir(directory, name, shard), name)
+        try:
+            _create_exclusive(path, data)
+        except FileExistsError:
+            # Same content, already stored
+            pass
+        return path
+    elif naming != 'counter':
+        raise Exception("Arg naming must be 'counter' or 'hash'")
+    
+    today = datetime.today().strftime('%Y-%m-%d')
+    # Counter hint, a missing or unreadable file just means starting from 0
+    hint_path = os.path.join(directory, '.img_counter')
+    counter = 0
+    try:
+        with open(hint_path) as file:
+            date, value = file.read().split()
+        if date == today:
+            counter = int(value)
+    except (OSError, ValueError):
+        pass
+    
+    while True:
+        name = ('img' if counter == 0 else 'img' + str(counter)) + ' ' + today + '.' + extension
+        path = os.path.join(_shard_dir(directory, name, shard), name)
+        try:
+            _create_exclusive(path, data)
+            break
+        except FileExistsError:
+            counter += 1
+    
+    # Save the next counter, the temporary file is unique per thread so writers never mix
+    tmp_path = hint_path + '.' + str(os.getpid()) + '.' + str(threading.get_ident())
+    with open(tmp_path, 'w') as file:
+        file.write(today + ' ' + str(counter + 1))
+    os.replace(tmp_path, hint_path)
+    return path
+
+
+# Supported output formats, maps format name -> file extension
+IMAGE_FORMATS = {'jpeg': 'jpeg', 'png': 'png', 'webp': 'webp'}
+
+
+def encode_image(img, format:str = 'jpeg', quality:int = None, optimize:bool = False, progressive:bool = False,
+                 subsampling = None, buffer = None):
+    """Encode img in memory and return a dict with the result and its cost:
+    {'data': bytes (None if buffer is set), 'format', 'size': bytes written, 'encode_time': seconds}
+    
+    Keyword arguments:
+    img -- PIL image
+    format -- 'jpeg', 'png' or 'webp'
+    quality -- jpeg 1-95 / webp 0-100, higher is bigger and better (default encoder default, 75 / 80)
+    optimize -- jpeg: optimal Huffman tables, png: smallest output (both slower)
+    progressive -- jpeg only, progressive encoding
+    subsampling -- jpeg only, chroma subsampling 0 (4:4:4), 1 (4:2:2) or 2 (4:2:0) (default encoder default)
+    buffer -- writable file-like object (e.g. io.BytesIO or a socket file), if set the output is written into it
+    """
+    
+    format = format.lower()
+    if format == 'jpg':
+        format = 'jpeg'
+    if format not in IMAGE_FORMATS:
+        raise Exception('format must be ' + ', '.join(IMAGE_FORMATS))
+    
+    # Only pass the options the encoder understands
+    options = {}
+    if quality != None and format in ['jpeg', 'webp']:
+        options['quality'] = quality
+    if optimize == True and format in ['jpeg', 'png']:
+        options['optimize'] = True
+    if progressive == True and format == 'jpeg':
+        options['progressive'] = True
+    if subsampling != None and format == 'jpeg':
+        options['subsampling'] = subsampling
+    
+    output = io.BytesIO() if buffer == None else buffer
+    start_position = output.tell() if output.seekable() else None
+    start = time.perf_counter()
+    img.save(output, format = format, **options)
+    encode_time = time.perf_counter() - start
+    
+    if buffer == None:
+        data = output.getvalue()
+        size = len(data)
+    else:
+        data = None
+        size = output.tell() - start_position if start_position != None else None
+    return {'data': data, 'format': format, 'size': size, 'encode_time': encode_time}
+
+
+@functools.lru_cache(maxsize = 256)
+def _cdf(p:tuple):
+    """Return the cumulative distribution of the probabilities p as a list, computed once per p
+    * It's the same distribution np.random.Generator.choice builds on every call, so
+    bisect_right(cdf, rng.random()) gives exactly the same result as rng.choice(len(p), p = p)
+    """
+    p = np.asarray(p, dtype = np.float64)
+    if (p < 0).any() or abs(p.sum() - 1) > np.sqrt(np.finfo(np.float64).eps):
+        raise Exception('probabilities p must be non-negative and sum to 1')
+    cdf = p.cumsum()
+    cdf /= cdf[-1]
+    return cdf.tolist()
+
+
+def _json_value(value):
+    """Return value if it can be stored in json, else its repr"""
+    if value == None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (list, tuple)) and len(value) <= 16:
+        return [_json_value(v) for v in value]
+    return repr(value)
+
+
+# Memory values of a span recorded by Tracer(memory=True), exported as attributes
+_MEMORY_KEYS = ['allocated_bytes', 'pillow_blocks', 'peak_rss_bytes']
+
+
+def _pillow_blocks():
+    """Return the number of image memory blocks Pillow allocated so far (new or reused from its cache)"""
+    stats = Image.core.get_stats()
+    return stats['allocated_blocks'] + stats['reused_blocks']
+
+
+class Tracer():
+    """Records a span (name, attributes, wall time and optionally allocated bytes) for every traced operation
+    * Set it with ArtGenerator(tracer=...) or create_*_art(tracer=...), with no tracer the cost of each
+    method is a single attribute check
+    * callback(span) is called when each span ends, spans are also kept in self.spans
+    * Export with to_chrome_trace() (chrome://tracing, Perfetto) or to_otel() (OpenTelemetry-like spans)
+    """
+    
+    
+    def __init__(self, callback = None, memory:bool = False, regions:bool = False, keep:bool = True):
+        """Keyword arguments:
+        callback -- function called with each finished span (dict)
+        memory -- if True record for each span: allocated_bytes, the peak Python/numpy bytes allocated (tracemalloc,
+        which doesn't see Pillow's buffers), pillow_blocks, the number of image memory blocks allocated by Pillow
+        (each one at most Image.core.get_block_size() bytes, 16 MB by default), and peak_rss_bytes, how much the
+        peak resident memory of the process grew (Pillow buffers included, Linux only, see _peak_memory; memory
+        freed earlier and reused doesn't count). Results are mixed if several threads trace at once.
+        tracemalloc slows down every allocation, if it wasn't already running it is started by the first span
+        and stopped when no span of this tracer is open anymore
+        regions -- if True record the bounding box of the pixels changed by each method (copies the image
+        before each call, expensive)
+        keep -- if False spans are only sent to callback, not kept in self.spans
+        """
+        self.callback = callback
+        self.memory = memory
+        self.regions = regions
+        self.keep = keep
+        self.spans = []
+        self._ids = itertools.count(1)
+        self._local = threading.local()
+        # Spans open in all threads, and whether this tracer started tracemalloc
+        self._open_spans = 0
+        self._started_tracemalloc = False
+        self._memory_lock = threading.Lock()
+        self.trace_id = os.urandom(16).hex()
+        # Wall clock at perf_counter 0, so spans can be exported with unix timestamps
+        self._epoch = time.time_ns() - time.perf_counter_ns()
+    
+    
+    @contextlib.contextmanager
+    def span(self, name:str, **attributes):
+        """Context manager recording one span, yields the span dict so attributes can be added to it"""
+        stack = self._local.__dict__.setdefault('stack', [])
+        span = {'name': name, 'id': next(self._ids), 'parent': stack[-1]['id'] if stack else None,
+                'thread': threading.get_ident(),
+                'attributes': {key: _json_value(value) for key, value in attributes.items()}}
+        if self.memory:
+            with self._memory_lock:
+                self._open_spans += 1
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    self._started_tracemalloc = True
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1]['_peak'] = max(stack[-1]['_peak'], peak)
+            tracemalloc.reset_peak()
+            span['_start_memory'] = span['_peak'] = current
+            span['_start_blocks'] = _pillow_blocks()
+            # The peak resident memory is reset like the tracemalloc peak, the parent keeps the peak so far
+            rss_peak = _peak_memory(reset = True)
+            if stack and rss_peak != None:
+                stack[-1]['_rss_peak'] = max(stack[-1]['_rss_peak'], rss_peak)
+            span['_start_rss'] = span['_rss_peak'] = _peak_memory()
+        stack.append(span)
+        span['start'] = time.perf_counter_ns()
+        try:
+            yield span
+        finally:
+            span['duration'] = time.perf_counter_ns() - span['start']
+            stack.pop()
+            if self.memory:
+                peak = max(span.pop('_peak'), tracemalloc.get_traced_memory()[1])
+                span['allocated_bytes'] = peak - span.pop('_start_memory')
+                if stack:
+                    stack[-1]['_peak'] = max(stack[-1]['_peak'], peak)
+                tracemalloc.reset_peak()
+                span['pillow_blocks'] = _pillow_blocks() - span.pop('_start_blocks')
+                rss_peak, start_rss = span.pop('_rss_peak'), span.pop('_start_rss')
+                if start_rss != None:
+                    rss_peak = max(rss_peak, _peak_memory(reset = True))
+                    span['peak_rss_bytes'] = rss_peak - start_rss
+                    if stack:
+                        stack[-1]['_rss_peak'] = max(stack[-1]['_rss_peak'], rss_peak)
+                with self._memory_lock:
+                    self._open_spans -= 1
+                    if self._open_spans == 0 and self._started_tracemalloc:
+                        tracemalloc.stop()
+                        self._started_tracemalloc = False
+            if self.keep:
+                self.spans.append(span)
+            if self.callback != None:
+                self.callback(span)
+    
+    
+    def annotate(self, **attributes):
+        """Add attributes to the innermost open span of the current thread (e.g. values chosen at random)"""
+        stack = self._local.__dict__.get('stack')
+        if stack:
+            stack[-1]['attributes'].update({key: _json_value(value) for key, value in attributes.items()})
+    
+    
+    def to_chrome_trace(self):
+        """Return the spans in Chrome trace event format (complete events, times in microseconds)"""
+        events = []
+        for span in self.spans:
+            args = dict(span['attributes'])
+            args.update({key: span[key] for key in _MEMORY_KEYS if key in span})
+            events.append({'name': span['name'], 'ph': 'X', 'pid': os.getpid(), 'tid': span['thread'],
+                           'ts': span['start']/1000, 'dur': span['duration']/1000, 'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+    
+    
+    def to_otel(self):
+        """Return the spans as OpenTelemetry-like dicts (ids in hex, unix times in nanoseconds)"""
+        spans = []
+        for span in self.spans:
+            attributes = dict(span['attributes'])
+            attributes.update({key: span[key] for key in _MEMORY_KEYS if key in span})
+            spans.append({'traceId': self.trace_id,
+                          'spanId': '%016x' % span['id'],
+                          'parentSpanId': '%016x' % span['parent'] if span['parent'] != None else '',
+                          'name': span['name'],
+                          'startTimeUnixNano': self._epoch + span['start'],
+                          'endTimeUnixNano': self._epoch + span['start'] + span['duration'],
+                          'attributes': attributes})
+        return spans
+    
+    
+    def save(self, path:str, format:str = 'chrome'):
+        """Save the spans as json, format 'chrome' or 'otel'"""
+        data = self.to_chrome_trace() if format == 'chrome' else self.to_otel()
+        with open(path, 'w') as file:
+            json.dump(data, file)
+
+
+def _span(tracer, name:str, **attributes):
+    """Return tracer.span(name) or a no-op context manager if tracer is None"""
+    if tracer == None:
+        return contextlib.nullcontext()
+    return tracer.span(name, **attributes)
+
+
+class AnimationRecorder():
+    """Turns the drawing of an artwork into an animation, one frame after each ArtGenerator method call
+    * Set it with ArtGenerator(animation=...) or create_*_art(animation=...)
+    * Calls that don't change the image add no frame, and with line_steps > 1 the line effects
+    (add_curve_effect and the parallel lines) are split in line_steps frames
+    * Frames are encoded while the artwork is drawn, by a background thread fed through a small bounded
+    queue. Memory by format: only 'raw' is constant (each frame is written and released). 'webp' keeps the
+    compressed frames: each frame is added to libwebp's animation encoder and released, through Pillow's
+    private _webp module; if it doesn't have the expected API (Pillow < 11 or a changed signature) Pillow's
+    writer is used and every full frame is kept until close(). 'gif' always keeps every full frame until close()
+    (Pillow's gif writer needs them).
+    The webp and gif encoders only store the region that changed in each frame
+    * format 'raw' writes the RGB bytes of each frame to a file-like object, e.g. the stdin of
+    ffmpeg -f rawvideo -pix_fmt rgb24 -s WxH -i -
+    * Call close() (or use it as a context manager) to finish the file
+    """
+    
+    
+    def __init__(self, output, format:str = 'webp', duration:int = 200, line_steps:int = 1, loop:int = 0,
+                 max_pending:int = 4, quality:int = 80, method:int = 0, lossless:bool = False):
+        """Keyword arguments:
+        output -- file path or writable file-like object
+        format -- 'webp' (animated), 'gif' (animated) or 'raw' (RGB bytes of each frame, one after the other)
+        duration -- time of each frame in ms
+        line_steps -- number of frames used to draw each group of lines
+        loop -- number of loops of the animation, 0 is forever
+        max_pending -- max number of frames waiting to be encoded
+        quality -- webp only, 0-100 (default 80, Pillow's default)
+        method -- webp only, 0 (fast) to 6 (smaller files)
+        lossless -- webp only, if True frames are encoded without loss
+        """
+        if format not in ['webp', 'gif', 'raw']:
+            raise Exception("Arg format must be 'webp', 'gif' or 'raw'")
+        self.output = output
+        self.format = format
+        self.duration = duration
+        self.line_steps = line_steps
+        self.loop = loop
+        self.quality = quality
+        self.method = method
+        self.lossless = lossless
+        self.frames = 0
+        self._previous = None
+        self._queue = queue.Queue(maxsize = max_pending)
+        self._thread = None
+        self._error = None
+    
+    
+    def __enter__(self):
+        return self
+    
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    
+    def _frames(self):
+        """Yield the queued frames until close() is called"""
+        while True:
+            frame = self._queue.get()
+            if frame == None:
+                return
+            yield frame
+    
+    
+    def _encode(self):
+        """Background thread, encodes every queued frame"""
+        try:
+            if self.format == 'raw':
+                file = open(self.output, 'wb') if isinstance(self.output, str) else self.output
+                try:
+                    for frame in self._frames():
+                        file.write(frame.tobytes())
+                finally:
+                    if isinstance(self.output, str):
+                        file.close()
+            else:
+                first = self._queue.get()
+                encoder = self._webp_encoder(first) if self.format == 'webp' else None
+                if encoder != None:
+                    self._encode_webp(encoder)
+                else:
+                    # Pillow's writers collect every frame before encoding
+                    options = {'quality': self.quality, 'method': self.method, 'lossless': self.lossless}
+                    first.save(self.output, format = self.format, save_all = True, append_images = self._frames(),
+                               duration = self.duration, loop = self.loop, **(options if self.format == 'webp' else {}))
+        except Exception as error:
+            self._error = error
+            # Keep consuming so add_frame never blocks
+            while self._queue.get() != None:
+                pass
+    
+    
+    def _webp_encoder(self, first):
+        """Return libwebp's animation encoder of Pillow's private _webp module with the frame first added,
+        or None if this Pillow doesn't have the API expected here (then Pillow's writer is used)
+        """
+        # Pillow's defaults for the settings that aren't recorder options
+        background, minimize_size, allow_mixed, verbose = 0, False, False, False
+        # Min and max distance between key frames
+        kmin, kmax = (9, 17) if self.lossless else (3, 5)
+        try:
+            from PIL import _webp
+            encoder = _webp.WebPAnimEncoder(first.size, background, self.loop, minimize_size, kmin, kmax,
+                                            allow_mixed, verbose)
+            self._add_webp(encoder, first, 0)
+        except (ImportError, AttributeError, TypeError):
+            return None
+        return encoder
+    
+    
+    def _add_webp(self, encoder, frame, timestamp:int):
+        """Add frame (None ends the last frame) starting at timestamp ms to the encoder of _webp_encoder"""
+        alpha_quality = 100
+        encoder.add(frame.getim() if frame != None else None, timestamp, self.lossless, self.quality,
+                    alpha_quality, self.method)
+    
+    
+    def _encode_webp(self, encoder):
+        """Add the queued frames one at a time to the encoder of _webp_encoder, so no full frame is kept
+        after it is added
+        """
+        timestamp = self.duration
+        for frame in self._frames():
+            self._add_webp(encoder, frame, timestamp)
+            timestamp += self.duration
+        self._add_webp(encoder, None, timestamp)
+        data = encoder.assemble('', '', '')
+        if data == None:
+            raise Exception('the webp encoder returned no data')
+        if isinstance(self.output, str):
+            with open(self.output, 'wb') as file:
+                file.write(data)
+        else:
+            self.output.write(data)
+    
+    
+    def add_frame(self, img):
+        """Queue a copy of img as the next frame, unless it is equal to the previous frame"""
+        if self._previous != None and self._previous.size == img.size:
+            if ImageChops.difference(self._previous, img).getbbox() == None:
+                return
+        frame = img.copy()
+        self._previous = frame
+        if self._thread == None:
+            self._thread = threading.Thread(target = self._encode, daemon = True)
+            self._thread.start()
+        self._queue.put(frame)
+        self.frames += 1
+    
+    
+    def close(self):
+        """Wait for the last frames to be encoded and finish the file"""
+        if self._thread != None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if self._error != None:
+            raise self._error
+
+
+def _traced(method):
+    """Decorator of ArtGenerator methods, records a span with the call arguments when self.tracer is set
+    and adds a frame to self.animation after the call when it is set
+    """
+    
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.tracer == None and self.animation == None:
+            return method(self, *args, **kwargs)
+        if self.tracer == None:
+            result = method(self, *args, **kwargs)
+        else:
+            attributes = dict(kwargs, args = args) if args else kwargs
+            with self.tracer.span(method.__name__, **attributes) as span:
+                before = self.img.copy() if self.tracer.regions and self.display_list == None else None
+                result = method(self, *args, **kwargs)
+                if before != None:
+                    # Region touched by the call, (x1,y1,x2,y2) or None if nothing changed
+                    region = None
+                    if before.size == self.img.size:
+                        region = ImageChops.difference(before, self.img).getbbox()
+                    span['attributes']['region'] = _json_value(region)
+        if self.animation != None and self.display_list == None:
+            self.animation.add_frame(self.img)
+        return result
+    return wrapper
+
 
 class ArtGenerator():
     """An ArtGenerator object has a main attribute: self.img 
@@ -28,19 +1029,56 @@ class ArtGenerator():
         - alter_background
         - add_curve_effect
         - smooth_lines
+    * In record mode (record=True) the methods append resolution-independent commands to self.display_list
+    instead of changing self.img, and render(size) rasterizes them once at any size
+    * With a Tracer (tracer=...) every public method call is recorded as a span
+    * With an AnimationRecorder (animation=...) every method call adds a frame to an animation
     """
 
     
-    def __init__(self, bg_type:str = 'white', img_size:tuple = (600,400)):
+    def __init__(self, bg_type:str = 'white', img_size:tuple = (600,400), seed = None, line_backend:str = 'pil',
+                 record:bool = False, smooth_backend:str = 'pil', tracer:Tracer = None,
+                 animation:AnimationRecorder = None, quality:str = 'standard'):
         """initialize object and creates the base image
         * The image backgorund color will be selected according to "bg_type",
         bg_type 'light' or 'dark' creates a random background color
+        * Every random choice of the object is drawn from its own numpy Generator (self.rng),
+        so the same seed always gives the same image and objects can be used from different threads
         
         Keyword arguments:
         bg_type -- Define the backgorund color, may be 'white','black', 'light' or 'dark' 
         img_size -- A 2-tuple, containing (width, height) in pixels
+        seed -- int (e.g. a 128 bit / 16 bytes int), np.random.SeedSequence or np.random.Generator (default random seed)
+        line_backend -- How the parallel lines effects are drawn, 'pil' (one ImageDraw call per line)
+        or 'numpy' (one batched rasterization per effect written in a crop of its bounding box, pixel-identical).
+        At the line counts of the effects Pillow's C loop is still faster (4K: ~4 ms against ~50 ms for the
+        four line effects), most of the numpy time is the copy of the bounding box, which spans the canvas
+        record -- if True methods don't change self.img, they append resolution-independent commands to
+        self.display_list, which can be rasterized at any size with self.render(size)
+        smooth_backend -- How smooth_lines filters the image, 'pil' (SMOOTH_MORE then BoxBlur, two new images)
+        or 'numpy' (both filters fused in one in-place pass, differs by a few levels at most)
+        tracer -- Tracer recording a span for each method call (default None, no tracing)
+        animation -- AnimationRecorder receiving a frame after each method call (default None)
+        quality -- 'draft', 'standard' or 'final', see QUALITY_TIERS and DisplayList.render. With 'draft' or
+        'final' the methods record commands (as with record=True) and self.render() returns the image
+        * When commands are recorded self.img stays the plain background: encode and save_img use self.render(),
+        checkpoints only keep the commands and an AnimationRecorder can't be used (it needs the pixels)
         """
+        if line_backend not in ['pil','numpy']:
+            raise Exception("Arg line_backend must be 'pil' or 'numpy'")
+        if smooth_backend not in ['pil','numpy']:
+            raise Exception("Arg smooth_backend must be 'pil' or 'numpy'")
+        if quality not in QUALITY_TIERS:
+            raise Exception('Arg quality must be ' + ', '.join(QUALITY_TIERS))
+        if animation != None and (record == True or quality != 'standard'):
+            raise Exception("animation needs quality 'standard' and record=False, the other modes only record commands")
         self.bg_type = bg_type
+        self.line_backend = line_backend
+        self.smooth_backend = smooth_backend
+        self.tracer = tracer
+        self.animation = animation
+        self.quality = quality
+        self.rng = np.random.default_rng(seed)
         
         # Set background colors according to "bg_type"
         if bg_type == 'white':
@@ -49,15 +1087,201 @@ class ArtGenerator():
             rgb_color = (0,0,0)
         # Select a random background with high values for RGB colors (close to white)
         elif bg_type == 'light':
-            rgb_color = tuple([random.randrange(235,255) for i in range(3)])
+            rgb_color = tuple([self._randrange(235,255) for i in range(3)])
         # Select a random background with low values for RGB colors (close to black)
         elif bg_type == 'dark':
-            rgb_color = tuple([random.randrange(50,100) for i in range(3)])
+            rgb_color = tuple([self._randrange(50,100) for i in range(3)])
         else:
             raise Exception("Arg bg_type must be 'white','black', 'light' or 'dark'")
 
         # Create a new image
         self.img =  Image.new('RGB',img_size,color=rgb_color) 
+        self.display_list = DisplayList(img_size, rgb_color) if record == True or quality != 'standard' else None
+        # Saved states (see checkpoint) and the tiles they point to, shared with branches
+        self.checkpoints = []
+        self._tiles = {}
+
+
+    def _randrange(self, start, stop = None):
+        """Return a random int in [start, stop) drawn from self.rng (same behavior as random.randrange)"""
+        if stop == None:
+            start, stop = 0, start
+        return int(self.rng.integers(int(start), int(stop)))
+
+
+    def _choice(self, options, p = None):
+        """Return a random element of options drawn from self.rng (same behavior as np.random.choice)
+        
+        Keyword arguments:
+        options -- sequence of options
+        p -- probabilities associated with each entry (default uniform)
+        """
+        if p == None:
+            return options[int(self.rng.integers(0, len(options)))]
+        if len(p) != len(options):
+            raise Exception('options and p must have the same length')
+        return options[bisect.bisect_right(_cdf(tuple(p)), self.rng.random())]
+
+
+    def _get_draw(self):
+        """Return the object the methods draw with, self.display_list in record mode or an ImageDraw of self.img"""
+        if self.display_list != None:
+            return self.display_list
+        return ImageDraw.Draw(self.img)
+
+
+    def render(self, size:tuple = None, quality:str = None):
+        """Return the recorded display list rasterized at size (only in record mode or with quality 'draft'/'final')
+        
+        Keyword arguments:
+        size -- 2-d tuple with (x,y) in pixels (default img_size)
+        quality -- 'draft', 'standard' or 'final' (default self.quality)
+        """
+        if self.display_list == None:
+            raise Exception('render is only available when the object is created with record=True')
+        return self.display_list.render(size, quality or self.quality)
+
+
+    def checkpoint(self, tile_size:int = 128):
+        """Save the current state and return its id, to go back to it with restore(id) or branch(id)
+        * self.img is stored as tiles identified by the hash of their pixels, a tile equal to one already
+        stored (in any checkpoint, position or branch) is not stored again, so each checkpoint costs
+        memory proportional to the tiles that changed since the others instead of a full image
+        * The random generator state is saved too, so restoring and calling the same methods gives the same image
+        * When commands are recorded (record=True, quality 'draft' or 'final') only the number of commands is saved
+        
+        Keyword arguments:
+        tile_size -- side of the tiles in pixels
+        """
+        
+        # Recorded commands, self.img is only the background
+        keys = None
+        if self.display_list == None:
+            pixels = np.asarray(self.img)
+            keys = []
+            for y in range(0, pixels.shape[0], tile_size):
+                for x in range(0, pixels.shape[1], tile_size):
+                    tile = pixels[y:y + tile_size, x:x + tile_size].tobytes()
+                    key = hashlib.blake2b(tile, digest_size = 16).digest()
+                    self._tiles.setdefault(key, tile)
+                    keys.append(key)
+        
+        self.checkpoints.append({'size': self.img.size, 'tile_size': tile_size, 'tiles': keys,
+                                 'rng_state': self.rng.bit_generator.state,
+                                 'commands': len(self.display_list.commands) if self.display_list != None else None})
+        return len(self.checkpoints) - 1
+    
+    
+    def restore(self, checkpoint:int = -1):
+        """Go back to a saved state (default the last checkpoint)
+        
+        Keyword arguments:
+        checkpoint -- id returned by checkpoint()
+        """
+        
+        state = self.checkpoints[checkpoint]
+        self.rng.bit_generator.state = state['rng_state']
+        if state['tiles'] == None:
+            del self.display_list.commands[state['commands']:]
+            return
+        width, height = state['size']
+        tile_size = state['tile_size']
+        pixels = np.empty((height, width, 3), dtype = np.uint8)
+        keys = iter(state['tiles'])
+        for y in range(0, height, tile_size):
+            for x in range(0, width, tile_size):
+                tile = pixels[y:y + tile_size, x:x + tile_size]
+                tile[:] = np.frombuffer(self._tiles[next(keys)], dtype = np.uint8).reshape(tile.shape)
+        self.img = Image.fromarray(pixels)
+    
+    
+    def branch(self, checkpoint:int = -1):
+        """Return a new ArtGenerator object in a saved state (default the last checkpoint)
+        * The new object shares the checkpoints and their tiles with this one, only its image is new
+        
+        Keyword arguments:
+        checkpoint -- id returned by checkpoint()
+        """
+        
+        new = self._fork(copy_img = False)
+        new.restore(checkpoint)
+        return new
+    
+    
+    def _fork(self, seed = None, copy_img:bool = True):
+        """Return a copy of this object with its own image, display list, checkpoints list and random generator
+        
+        Keyword arguments:
+        seed -- seed of the new random generator (default random)
+        copy_img -- if False the image is shared, the caller must replace it
+        """
+        new = copy.copy(self)
+        new.rng = np.random.default_rng(seed)
+        new.checkpoints = list(self.checkpoints)
+        if copy_img == True:
+            new.img = self.img.copy()
+        if self.display_list != None:
+            new.display_list = copy.copy(self.display_list)
+            new.display_list.commands = list(self.display_list.commands)
+        return new
+    
+    
+    def fan_out(self, suffix, n:int, seed = None, workers:int = None):
+        """Return n new ArtGenerator objects, each one is a copy of this object changed by suffix
+        * The current image (the shared prefix) is rendered only once, each variant only pays for suffix
+        * Each variant has its own random generator spawned from seed, so the same seed gives the same variants
+        * Variants are made in parallel by a thread pool, they don't add animation frames
+        
+        Keyword arguments:
+        suffix -- function(ArtGenerator) that changes a variant, e.g. lambda im: im.draw_regular_polygon()
+        n -- number of variants
+        seed -- seed used to spawn one seed per variant (default random)
+        workers -- number of threads (default os.cpu_count(), 1 runs in the calling thread)
+        """
+        
+        def make_variant(variant_seed):
+            variant = self._fork(variant_seed)
+            variant.animation = None
+            suffix(variant)
+            return variant
+        
+        seeds = np.random.SeedSequence(seed).spawn(n)
+        if workers == 1:
+            return [make_variant(variant_seed) for variant_seed in seeds]
+        with ThreadPoolExecutor(max_workers = workers or os.cpu_count() or 1) as executor:
+            return list(executor.map(make_variant, seeds))
+
+
+    def _draw_line_family(self, lines:list, color:tuple):
+        """Draws a group of 1 pixel width lines with the same color using self.line_backend
+        
+        Keyword arguments:
+        lines -- list of (x1,y1,x2,y2) int coordinates
+        color -- RGB color
+        """
+        
+        if len(lines) == 0:
+            return
+        draw = self._get_draw()
+        # Animated, the lines are drawn in line_steps groups with a frame after each one
+        steps = 1
+        if self.animation != None and self.display_list == None:
+            steps = max(1, min(self.animation.line_steps, len(lines)))
+        for step in range(steps):
+            group = lines[len(lines)*step//steps:len(lines)*(step + 1)//steps]
+            if self.line_backend == 'numpy' and self.display_list == None:
+                # All pixels of all lines written with a single scatter, only the area of the lines is copied
+                x, y = _rasterize_lines(group, self.img.size)
+                if len(x) > 0:
+                    x_min, y_min = int(x.min()), int(y.min())
+                    region = np.array(self.img.crop((x_min, y_min, int(x.max()) + 1, int(y.max()) + 1)))
+                    region[y - y_min, x - x_min] = color
+                    self.img.paste(Image.fromarray(region), (x_min, y_min))
+            else:
+                for line in group:
+                    draw.line(line, fill= color,width = 1)
+            if step < steps - 1:
+                self.animation.add_frame(self.img)
 
         
     def create_color(self,contrast:bool = True):
@@ -73,20 +1297,21 @@ class ArtGenerator():
         if contrast == True:
             if self.bg_type == 'white' or self.bg_type == 'light':
                 # selects a random color from a low-intensity spectrum
-                color = tuple([random.randrange(50,100) for i in range(3)])
+                color = tuple([self._randrange(50,100) for i in range(3)])
             elif self.bg_type == 'black' or self.bg_type == 'dark':
                 # Selects a random color from a high-intensity spectrum
-                color = tuple([random.randrange(100,200) for i in range(3)])
+                color = tuple([self._randrange(100,200) for i in range(3)])
         # Select colors that don't contrast with background
         else:
             if self.bg_type == 'white' or self.bg_type == 'light':
-                color = tuple([random.randrange(100,200) for i in range(3)])
+                color = tuple([self._randrange(100,200) for i in range(3)])
             elif self.bg_type == 'black' or self.bg_type == 'dark':
-                color = tuple([random.randrange(50,100) for i in range(3)])
+                color = tuple([self._randrange(50,100) for i in range(3)])
         
         return color
     
     
+    @_traced
     def alter_background(self,repeat:int = None, allow_circle:bool = True):
         """Changes the background randomly, possibilities:
         * Splits the screen into 2-4 random colors (rectangular) 
@@ -101,22 +1326,22 @@ class ArtGenerator():
         
         # 50% chance to change background twice
         if repeat == None:
-            repeat = random.randrange(1,3)
+            repeat = self._randrange(1,3)
         
-        draw = ImageDraw.Draw(self.img)
+        draw = self._get_draw()
         for i in range(repeat):
-            color = self.create_color(contrast =  random.choice([True,False]))
+            color = self.create_color(contrast =  self._choice([True,False]))
             
             # Randomly select change type 
             if allow_circle == True:
                 if i == 0:
-                    random_option = random.randrange(1,9)
+                    random_option = self._randrange(1,9)
                 # In the 2nd loop select only rectangular shapes, Arcs doesn't look good when multiplied
                 else:
-                    random_option = random.randrange(1,4) 
+                    random_option = self._randrange(1,4) 
             # Chose only retangular shapes
             elif allow_circle == False:
-                random_option = random.randrange(1,4) 
+                random_option = self._randrange(1,4) 
                   
             if random_option == 1:
                 # 1/3 rectangle (divede divide height)
@@ -148,6 +1373,7 @@ class ArtGenerator():
                 pass
 
             
+    @_traced
     def add_curve_effect(self,corner_choice:str = None):
         """ Draws a sequence of lines that creates the impression of a curve
         If corner_choice is not set the effect will be randomly draw to one position option.
@@ -158,58 +1384,60 @@ class ArtGenerator():
         
         # Select position
         if corner_choice == None:
-            corner_choice = np.random.choice(['upper_right','lower_left','middle'], p = (0.25,0.25,0.5)) # 50% chance of middle
+            corner_choice = self._choice(['upper_right','lower_left','middle'], p = (0.25,0.25,0.5)) # 50% chance of middle
 
         # Draw lines
-        draw = ImageDraw.Draw(self.img)
         color = self.create_color()
+        lines = []
         
         if corner_choice == 'upper_right':
             # Coordinates of first line
-            point_x1 = random.randrange(int(self.img.size[0]*0.6))
+            point_x1 = self._randrange(int(self.img.size[0]*0.6))
             point_y1 = 0
             point_x2 = self.img.size[0]
             line_coords = [point_x1,point_y1,point_x2,point_y1]
             # Draw lines 
-            line_space = random.randrange(10,25) # Random space between lines
+            line_space = self._randrange(10,25) # Random space between lines
             for i in range(70):
                 # Randon incremental increase in coord points x1 and y2 keeping  y1 and x1 fixed
-                draw.line((line_coords[0]+ i*line_space,
-                           line_coords[1] ,
-                           line_coords[2],
-                           line_coords[3]+ i*line_space), fill= color,width = 1)
+                lines.append((line_coords[0]+ i*line_space,
+                              line_coords[1] ,
+                              line_coords[2],
+                              line_coords[3]+ i*line_space))
             
         elif corner_choice == 'lower_left': 
             # Coordinates of first line
-            point_x1 = random.randrange(int(self.img.size[0]*0.3),int(self.img.size[0]))
+            point_x1 = self._randrange(int(self.img.size[0]*0.3),int(self.img.size[0]))
             point_y1 = self.img.size[1]
             point_x2 = 0
             line_coords = [point_x1,point_y1,point_x2,point_y1]
             # Draw lines
-            line_space = random.randrange(10,25)
+            line_space = self._randrange(10,25)
             for i in range(70):
-                draw.line((line_coords[0]- i*line_space,
-                           line_coords[1] ,
-                           line_coords[2],
-                           line_coords[3]- i*line_space), fill= color,width = 1)
+                lines.append((line_coords[0]- i*line_space,
+                              line_coords[1] ,
+                              line_coords[2],
+                              line_coords[3]- i*line_space))
                 
         elif corner_choice =='middle':
             # Coordinates of first line
-            point_x1 = random.randrange(self.img.size[0],self.img.size[0]*1.4)
-            point_y1 = random.randrange(self.img.size[1]*0.8,self.img.size[1]*1.2)
-            point_x2 = random.randrange(self.img.size[0]*-0.3,0)
+            point_x1 = self._randrange(self.img.size[0],self.img.size[0]*1.4)
+            point_y1 = self._randrange(self.img.size[1]*0.8,self.img.size[1]*1.2)
+            point_x2 = self._randrange(self.img.size[0]*-0.3,0)
             point_y2 = self.img.size[1]-point_x1
             line_coords = [point_x1,point_y1,point_x2,point_y2]
 
             # Draw lines
-            line_space = random.randrange(10,20) 
-            for i in range(random.randrange(10,30)):
-                draw.line((line_coords[0]+ i*line_space,
-                           line_coords[1] ,
-                           line_coords[2],
-                           line_coords[3]+ i*line_space), fill= color,width = 1)
+            line_space = self._randrange(10,20) 
+            for i in range(self._randrange(10,30)):
+                lines.append((line_coords[0]+ i*line_space,
+                              line_coords[1] ,
+                              line_coords[2],
+                              line_coords[3]+ i*line_space))
+        self._draw_line_family(lines, color)
 
     
+    @_traced
     def draw_vertical_lines(self,repeat:int = None):
         """Draws a sequence of vertical parallel lines
         * Number of lines and spacing will be random
@@ -219,27 +1447,29 @@ class ArtGenerator():
         """
         
         # Coordinates of first line
-        point_x1 = random.randrange(0,self.img.size[1])
+        point_x1 = self._randrange(0,self.img.size[1])
         point_y1 = 0
         point_y2 = self.img.size[1]
         line_coords = [point_x1,point_y1,point_x1,point_y2]
         
         # Draw lines
-        draw = ImageDraw.Draw(self.img)
         color = self.create_color()
+        lines = []
         # 50% chance to repeat the drawing in the same coordinates but with different args
         if repeat == None:
-            repeat = random.randrange(1,3)
+            repeat = self._randrange(1,3)
         for n in range(repeat):
-            line_space = random.randrange(5,20) # Random space between lines
-            for i in range(random.randrange(7,25)):
+            line_space = self._randrange(5,20) # Random space between lines
+            for i in range(self._randrange(7,25)):
                 # Randon incremental increase in coord points x1 and x2 keeping  y1 and y2 fixed
-                draw.line((line_coords[0]+ i*line_space,
-                           line_coords[1] ,
-                           line_coords[2]+ i*line_space,
-                           line_coords[3]), fill= color,width = 1)
+                lines.append((line_coords[0]+ i*line_space,
+                              line_coords[1] ,
+                              line_coords[2]+ i*line_space,
+                              line_coords[3]))
+        self._draw_line_family(lines, color)
      
      
+    @_traced
     def draw_horizontal_lines(self,repeat:int = None):
         """Draws a sequence of horizontal parallel lines
         * Number of lines and lines spacing will be random
@@ -250,29 +1480,30 @@ class ArtGenerator():
     
         # Coordinates of first line
         point_x = 0
-        point_y = random.randrange(0,self.img.size[1]*0.8)
+        point_y = self._randrange(0,self.img.size[1]*0.8)
         point_x2 = self.img.size[0]
         point_y2 = point_y
         line_coords = [point_x,point_y,point_x2,point_y2]
 
         # Draw lines 
-        draw = ImageDraw.Draw(self.img)
         color = self.create_color()
+        lines = []
         
         # 50% chance to repeat the drawing in the same coordinates but with different args
         if repeat == None:
-            repeat = random.randrange(1,3)
+            repeat = self._randrange(1,3)
         for n in range(repeat):
-            for i in range(random.randrange(7,25)):
-                line_space = random.randrange(5,20) # Random space between lines
+            for i in range(self._randrange(7,25)):
+                line_space = self._randrange(5,20) # Random space between lines
                 # Incremental increase in coord points y1 and x2 keeping  x2 and y1 fixed
-                draw.line((line_coords[0],
-                           line_coords[1]+ i*line_space, 
-                           line_coords[2],
-                           line_coords[3]+ i*line_space),
-                          fill= color,width = 1)
+                lines.append((line_coords[0],
+                              line_coords[1]+ i*line_space, 
+                              line_coords[2],
+                              line_coords[3]+ i*line_space))
+        self._draw_line_family(lines, color)
             
             
+    @_traced
     def draw_diagonal_lines(self,repeat:int = None):
         """Draws a sequence of vertical parallel lines
         * Number of lines and spacing will be random
@@ -282,28 +1513,30 @@ class ArtGenerator():
         """
         
         # Set start coord
-        point_x1 = random.choice([random.randrange(self.img.size[0]*-0.2,self.img.size[0]*0.5),
-                   random.randrange(self.img.size[0]*0.8,self.img.size[0]*1.6)])
+        point_x1 = self._choice([self._randrange(self.img.size[0]*-0.2,self.img.size[0]*0.5),
+                   self._randrange(self.img.size[0]*0.8,self.img.size[0]*1.6)])
         point_y1 = 0
         point_x2 = 0
         point_y2 = point_x1
         line_coords = [point_x1,point_y1,point_x2,point_y2]
 
         # Draw lines
-        draw = ImageDraw.Draw(self.img)
         color = self.create_color()
+        lines = []
         # 50% chance to repeat the drawing in the same coordinates but with different args
         if repeat == None:
-            repeat = random.randrange(1,3)
+            repeat = self._randrange(1,3)
         for n in range(repeat):
-            line_space = random.randrange(5,20)
-            for i in range(random.randrange(10,40)):
-                draw.line((line_coords[0]+ i*line_space,
-                           line_coords[1] ,
-                           line_coords[2],
-                           line_coords[3]+ i*line_space), fill= color,width = 1)
+            line_space = self._randrange(5,20)
+            for i in range(self._randrange(10,40)):
+                lines.append((line_coords[0]+ i*line_space,
+                              line_coords[1] ,
+                              line_coords[2],
+                              line_coords[3]+ i*line_space))
+        self._draw_line_family(lines, color)
 
     
+    @_traced
     def draw_regular_polygon(self,n_sides = None, radius = None):
         """Draws a random polygon (3,4,5,7,8,12,60 ~circle) in self.img
         * The size of the polygon will also be random
@@ -315,39 +1548,49 @@ class ArtGenerator():
         radius -- The polygon radius (default random value between 50 and 150)
         """
         
-        draw = ImageDraw.Draw(self.img)
+        draw = self._get_draw()
         color = self.create_color()
         
         # Selecting polygon position
         point_x = self.img.size[0]/2
-        point_y = random.choice([self.img.size[1]/2,
+        point_y = self._choice([self.img.size[1]/2,
                                  self.img.size[1]/2 + self.img.size[1]/8,
                                  self.img.size[1]/2 - self.img.size[1]/8])
         # draw random polygon 
         if n_sides == None:
-            n_sides =  np.random.choice([3,4,5,7,8,12,60], p = (0.22,0.13,0.13,0.13,0.13,0.13,0.13))
+            n_sides =  self._choice([3,4,5,7,8,12,60], p = (0.22,0.13,0.13,0.13,0.13,0.13,0.13))
         elif n_sides not in [3,4,5,7,8,12,60]:
             raise Exception('n_sides must 3,4,5,7,8,12 or 60')
 
         if radius == None:
-            radius = random.randrange(50,150) 
+            radius = self._randrange(50,150) 
         
         draw.regular_polygon((point_x, point_y,radius),
                              int(n_sides),
                              fill=color,
-                             outline=random.choice([0,None]))
+                             outline=self._choice([0,None]))
         
         
-    def draw_artistic_polygon(self):
-        """Draws a random irregular polygon with 100 sides in self.img
+    @_traced
+    def draw_artistic_polygon(self, n_vertices:int = 100, fill_backend:str = 'pil'):
+        """Draws a random irregular polygon in self.img
         * The position and colors will be random
         * The polygon will be constrained to an area ~1/4 of the image area
+        * With fill_backend 'numpy' the time grows linearly with n_vertices (10^5 vertices take
+        less than a second), with 'pil' it becomes quadratic after ~10^4 vertices
+        
+        Keyword arguments:
+        n_vertices -- number of random vertices after the first point
+        fill_backend -- 'pil' (ImageDraw.polygon) or 'numpy' (even-odd scanline fill, a few boundary
+        pixels differ from 'pil'), in record mode the polygon is always recorded for ImageDraw
         """
         
+        if fill_backend not in ['pil','numpy']:
+            raise Exception("Arg fill_backend must be 'pil' or 'numpy'")
+        
         # first point
-        point_x = random.randrange(self.img.size[0]*0.1, self.img.size[0]*0.9)
-        point_y = random.randrange(self.img.size[1]*0.1, self.img.size[1]*0.9)
-        poly_coords = [point_x,point_y]
+        point_x = self._randrange(self.img.size[0]*0.1, self.img.size[0]*0.9)
+        point_y = self._randrange(self.img.size[1]*0.1, self.img.size[1]*0.9)
 
         # X coordinate constraints
         if point_x <= int(self.img.size[0]/4):
@@ -370,21 +1613,25 @@ class ArtGenerator():
             limit_inf_y = point_y - int(self.img.size[1]/4)
             limit_sup_y = point_y + int(self.img.size[1]/4)
 
-        # Random coordinates according to constraints
-        for i in range(100):
-            point_x = random.randrange(limit_inf_x,limit_sup_x)
-            point_y = random.randrange(limit_inf_y,limit_sup_y)
-            poly_coords = poly_coords + [point_x,point_y]
+        # Random coordinates according to constraints, drawn at once in the same order
+        # as one x and one y per vertex
+        poly_coords = np.empty((n_vertices + 1, 2), dtype = np.int64)
+        poly_coords[0] = point_x, point_y
+        poly_coords[1:] = self.rng.integers([limit_inf_x,limit_inf_y], [limit_sup_x,limit_sup_y], size = (n_vertices,2))
             
-        # draw 100 sides random polygon
-        draw = ImageDraw.Draw(self.img)
+        # draw random polygon
         color = self.create_color()
-        draw.polygon(tuple(poly_coords),
+        if fill_backend == 'numpy' and self.display_list == None:
+            _fill_polygon(self.img, poly_coords, color)
+            return
+        draw = self._get_draw()
+        draw.polygon(poly_coords.ravel().tolist(),
                      fill=color,
                      outline=None, # 50% chance to have a contour
                      width=1)
         
 
+    @_traced
     def draw_line(self,qnt_lines:int = 1,random_qnt_lines:bool = False,width:int = 1,sequential_lines:bool = True):
         """Draws one or more lines with random coordinates and color in the base image (self.img)
         
@@ -402,37 +1649,38 @@ class ArtGenerator():
         if sequential_lines == True:
             line_coords = []
             if random_qnt_lines == True:
-                qnt_points = random.randrange(2,6)
+                qnt_points = self._randrange(2,6)
             else:
                 qnt_points = qnt_lines +1
             # Random coordinates
             for n in range(qnt_points):
-                point_x = random.randrange(0,self.img.size[0])
-                point_y = random.randrange(0,self.img.size[1])
+                point_x = self._randrange(0,self.img.size[0])
+                point_y = self._randrange(0,self.img.size[1])
                 coord_n = [point_x,point_y]
                 line_coords = coord_n + line_coords
             # Draw line
-            draw = ImageDraw.Draw(self.img)
+            draw = self._get_draw()
             draw.line(line_coords, fill= line_color,width = width)
             
         # Draw separate lines
         elif sequential_lines == False:
             if random_qnt_lines == True:
-                qnt_lines = random.randrange(1,3)
+                qnt_lines = self._randrange(1,3)
                 
             for line in range(qnt_lines):
                 # Create the line coordinate points
                 line_coords = []
                 for i in range(2):
-                    point_x = random.randrange(0,self.img.size[0])
-                    point_y = random.randrange(0,self.img.size[1])
+                    point_x = self._randrange(0,self.img.size[0])
+                    point_y = self._randrange(0,self.img.size[1])
                     coord_i = [point_x,point_y]
                     line_coords = line_coords + coord_i
                 # Draw line 
-                draw = ImageDraw.Draw(self.img)
+                draw = self._get_draw()
                 draw.line(line_coords, fill= line_color,width = width, joint = 'curve')
                 
 
+    @_traced
     def draw_arc(self, fill_arc:bool = True):
         """Draws one arc with random coordinates and color in the base image (self.img)
         
@@ -447,27 +1695,28 @@ class ArtGenerator():
         arc_coords = []
         for i in range(2):
             if i == 0:
-                point_x1 = random.randrange(0,self.img.size[0])
-                point_y1 = random.randrange(0,self.img.size[1])
+                point_x1 = self._randrange(0,self.img.size[0])
+                point_y1 = self._randrange(0,self.img.size[1])
                 coord_i = [point_x1,point_y1]
             else:
-                point_x2 = random.randrange(point_x1,self.img.size[0])
-                point_y2 = random.randrange(point_y1,self.img.size[1])  
+                point_x2 = self._randrange(point_x1,self.img.size[0])
+                point_y2 = self._randrange(point_y1,self.img.size[1])  
                 coord_i = [point_x2,point_y2]    
             arc_coords = arc_coords + coord_i
     
         # Arc angles
-        start_angle =  random.randrange(0,180)
-        end_angle = random.randrange(start_angle + 50,start_angle + 200)
+        start_angle =  self._randrange(0,180)
+        end_angle = self._randrange(start_angle + 50,start_angle + 200)
 
         # Draw arc 
-        draw = ImageDraw.Draw(self.img)
+        draw = self._get_draw()
         if fill_arc == True:
             draw.chord(arc_coords, start_angle, end_angle, fill=arc_color, width=1)
         elif fill_arc == False:
             draw.arc(arc_coords, start_angle, end_angle, fill=arc_color, width=1)
 
             
+    @_traced
     def draw_ellipse(self):
         """Draws one ellipse with random coordinates and color in the base image (self.img)
         """
@@ -481,51 +1730,102 @@ class ArtGenerator():
         elp_coords = []
         for i in range(2):
             if i == 0:
-                point_x1 = random.randrange(0,self.img.size[0])
-                point_y1 = random.randrange(0,self.img.size[1])
+                point_x1 = self._randrange(0,self.img.size[0])
+                point_y1 = self._randrange(0,self.img.size[1])
                 coord_i = [point_x1,point_y1]
             else:
-                point_x2 = random.randrange(point_x1 ,point_x1 + max_length)
-                point_y2 = random.randrange(point_y1 ,point_y1 + max_length)  
+                point_x2 = self._randrange(point_x1 ,point_x1 + max_length)
+                point_y2 = self._randrange(point_y1 ,point_y1 + max_length)  
                 coord_i = [point_x2,point_y2]    
             elp_coords = elp_coords + coord_i    
     
-        draw = ImageDraw.Draw(self.img)
+        draw = self._get_draw()
         draw.ellipse(elp_coords, fill=elp_color, width=1)
         
         
-    def draw_points(self,pts_qty:int = 10, randon_qty:bool = True, select_quadrant:bool = True):
+    @_traced
+    def draw_points(self,pts_qty:int = 10, randon_qty:bool = True, select_quadrant:bool = True, density:int = None,
+                    opacity:float = None):
         """Draws points in the base image (self.img)
+        * With density set (stipple and dust textures) all the points are generated and drawn at once
+        with numpy, millions of points take well under a second
         
         Keyword arguments:
         pts_qty -- Number of points
         randon_qty -- if True, ignore pts_qty and draw a random number between 1-30
         select_quadrant -- if True, points will be drawn in a restrict random part of image
+        density -- if set, ignore pts_qty and randon_qty and draw this number of points at once
+        opacity -- only with density, if set each point is blended with this opacity (0-1], so pixels hit
+        by many points get darker/stronger colors (default opaque points)
         """ 
         
         # Sets points color (random)
         points_color = self.create_color()
+        if density != None:
+            self._scatter_points(density, points_color, select_quadrant, opacity)
+            return
         # Set points qty
         if randon_qty == True:
-            pts_qty = random.randrange(1,30)
+            pts_qty = self._randrange(1,30)
         # Draw Points
         if select_quadrant == False:
-            draw = ImageDraw.Draw(self.img)
+            draw = self._get_draw()
             for p in range(pts_qty):
-                random_coord = (random.randrange(0,self.img.size[0]),random.randrange(0,self.img.size[1]))
+                random_coord = (self._randrange(0,self.img.size[0]),self._randrange(0,self.img.size[1]))
                 draw.point(random_coord, fill=points_color)
         if select_quadrant == True:
-            draw = ImageDraw.Draw(self.img)
-            x_min = (random.randrange(0,self.img.size[0]- int(self.img.size[0]/4)))
+            draw = self._get_draw()
+            x_min = (self._randrange(0,self.img.size[0]- int(self.img.size[0]/4)))
             x_max = (x_min+int(self.img.size[0]/3))
-            y_min = (random.randrange(0,self.img.size[1]- int(self.img.size[1]/4)))
+            y_min = (self._randrange(0,self.img.size[1]- int(self.img.size[1]/4)))
             y_max = (y_min+int(self.img.size[1]/3)) 
             
             for p in range(pts_qty):
-                random_coord = (random.randrange(x_min,x_max),random.randrange(y_min,y_max))
+                random_coord = (self._randrange(x_min,x_max),self._randrange(y_min,y_max))
                 draw.point(random_coord, fill=points_color)
+                
+                
+    def _scatter_points(self, qty:int, color:tuple, select_quadrant:bool = True, opacity:float = None):
+        """Draws qty random points with a single scatter in the pixel buffer (density mode of draw_points)
+        
+        Keyword arguments:
+        qty -- number of points
+        color -- RGB color
+        select_quadrant -- if True, points will be drawn in a restrict random part of image
+        opacity -- if set, the number of points on each pixel is counted (bincount) and the color is blended
+        with 1 - (1 - opacity)**count
+        """
+        
+        width, height = self.img.size
+        x_min, x_max, y_min, y_max = 0, width, 0, height
+        if select_quadrant == True:
+            # Same area as draw_points, clipped to the image so every point is visible
+            x_min = self._randrange(0,width - int(width/4))
+            x_max = min(x_min + int(width/3), width)
+            y_min = self._randrange(0,height - int(height/4))
+            y_max = min(y_min + int(height/3), height)
+        xs = self.rng.integers(x_min, x_max, qty, dtype = np.int32) - x_min
+        ys = self.rng.integers(y_min, y_max, qty, dtype = np.int32) - y_min
+        
+        if self.display_list != None:
+            if opacity != None:
+                raise Exception('opacity is not available in record mode')
+            self.display_list.point(np.column_stack((xs + x_min, ys + y_min)).ravel(), fill = color)
+            return
+        
+        # Only the area of the points is copied to an array
+        region = np.array(self.img.crop((x_min, y_min, x_max, y_max)))
+        if opacity == None:
+            region[ys, xs] = color
+        else:
+            counts = np.bincount(ys.astype(np.int64)*(x_max - x_min) + xs, minlength = region.shape[0]*region.shape[1])
+            alpha = 1 - np.power(np.float32(1 - opacity), counts.reshape(region.shape[:2]).astype(np.float32))
+            alpha = alpha[:, :, None]
+            region = (region*(1 - alpha) + np.array(color, dtype = np.float32)*alpha + 0.5).astype(np.uint8)
+        self.img.paste(Image.fromarray(region), (x_min, y_min))
                                       
                                          
+    @_traced
     def smooth_lines(self, random_blur:bool = True):
         """Smooth lines by a random factor or by 0.5 (slightly smooth) 
         
@@ -535,132 +1835,1610 @@ class ArtGenerator():
           
         if random_blur == True:
         # Random float 
-            blur_factor = random.randrange(1,4,1)/random.randrange(1,6)
+            blur_factor = self._randrange(1,4)/self._randrange(1,6)
         elif random_blur == False:
             blur_factor = 0.5 
+        if self.tracer != None:
+            self.tracer.annotate(blur_factor = blur_factor)
         # Apply filters
-        self.img = self.img.filter(ImageFilter.SMOOTH_MORE)
-        self.img = self.img.filter(ImageFilter.BoxBlur(blur_factor))
+        if self.display_list != None:
+            self.display_list.smooth(blur_factor, self.smooth_backend)
+            return
+        self.img = _smooth(self.img, blur_factor, self.smooth_backend)
 
 
-    def save_img(self,path:str = None):
-        """Save the image with .jpeg format 
-        * if path is not set an  unique name will be chosen for the file for the file, preventing overwritten 
+    @_traced
+    def encode(self, format:str = 'jpeg', quality:int = None, optimize:bool = False, progressive:bool = False,
+               subsampling = None, buffer = None):
+        """Encode self.img in memory, without any temporary file, see encode_image
+        * When commands are recorded (record=True, quality 'draft' or 'final') self.render() is encoded
+        * Returns a dict {'data': bytes (None if buffer is set), 'format', 'size', 'encode_time'}
         
         Keyword arguments:
-        path -- save file path (default workdir)
+        format -- 'jpeg', 'png' or 'webp'
+        quality -- jpeg 1-95 / webp 0-100 (default encoder default)
+        optimize -- jpeg/png, smaller output but slower encoding
+        progressive -- jpeg only, progressive encoding
+        subsampling -- jpeg only, chroma subsampling 0 (4:4:4), 1 (4:2:2) or 2 (4:2:0)
+        buffer -- writable file-like object, if set the output is written into it
         """
+        img = self.render() if self.display_list != None else self.img
+        return encode_image(img, format, quality, optimize, progressive, subsampling, buffer)
+
+
+    @_traced
+    def save_img(self,path:str = None, directory:str = '.', naming:str = 'counter', shard:str = None,
+                 format:str = 'jpeg'):
+        """Save the image (default .jpeg format) and return the file path
+        * When commands are recorded (record=True, quality 'draft' or 'final') self.render() is saved
+        * if path is not set an unique name will be chosen for the file in directory, preventing overwritten.
+        Finding the name doesn't depend on the number of files in directory and is safe when
+        several processes save in the same directory
         
-        # Save img in user defined path
+        Keyword arguments:
+        path -- save file path (default unique name in directory)
+        directory -- directory used when path is not set (default workdir)
+        naming -- 'counter' ('img <date>.jpeg', 'img1 <date>.jpeg'...) or 'hash' (sha1 of the file content)
+        shard -- None, 'date' (one subdirectory per day) or 'hash' (256 subdirectories), useful for millions of files
+        format -- 'jpeg', 'png' or 'webp'
+        """
+        
+        data = self.encode(format)['data']
+        extension = IMAGE_FORMATS[format.lower().replace('jpg', 'jpeg')]
+        # Save img in user defined path
         if path != None:
-            if re.search('.jpeg',path):
-                self.img.save(path , format='jpeg')
-            else:
-                self.img.save(path + '.jpeg' , format='jpeg')
-        # Save img in workdir
-        else:
-            # Finds a unique name for the file, preventing files from being overwritten
-            files = os.listdir(path)
-            today = datetime.today().strftime('%Y-%m-%d')
-            first_option_name = 'img '+  today + '.jpeg'
-            if first_option_name in files:
-                counter = 1
-                while True:
-                    file_name = 'img'+ str(counter) + ' ' + today + '.jpeg'
-                    counter+=1
-                    if file_name not in files:
-                        break
-                self.img.save(file_name + '.jpeg' , format='jpeg')
+            if not re.search(r'\.' + extension + '$',path):
+                path = path + '.' + extension
+            with open(path, 'wb') as file:
+                file.write(data)
+            return path
+        # Save img in directory with an unique name
+        return _write_unique(data, directory, naming, shard, extension)
+
+
+# Predefined art styles as data
+# * bg_type and every value of a stage may be a constant, a choice {'options': [...], 'p': [...]} ('p' default uniform)
+# or an int range {'range': [start, stop]}
+# * Stages run in order, each one calls an ArtGenerator method ('method', a name or a choice of names) with 'args',
+# 'when' (a choice of True/False) skips the stage and 'repeat' (a choice of ints) calls the method several times
+STYLE_SPECS = {
+    'chaotic': {
+        'bg_type': {'options': ['light','dark','white','black'], 'p': [0.45,0.45,0.05,0.05]},
+        'stages': [
+            {'name': 'background', 'method': 'alter_background'},
+            # Draw 1-3 Groups of lines, i.e. lines of same color (1% chance of 0 lines)
+            {'name': 'lines', 'method': 'draw_line',
+             'repeat': {'options': [1,2,3,0], 'p': [0.33,0.33,0.33,0.01]},
+             'args': {'random_qnt_lines': True,
+                      'width': {'options': [1,5,2,3,4], 'p': [0.35,0.35,0.1,0.1,0.1]},
+                      'sequential_lines': {'options': [True,False]}}},
+            # Draw 1-3 Arcs 1% chance of 0 arcs)
+            {'name': 'arcs', 'method': 'draw_arc',
+             'repeat': {'options': [1,2,3,0], 'p': [0.33,0.33,0.33,0.01]},
+             'args': {'fill_arc': {'options': [True,False]}}},
+            # 30% Chance of drawing a ellipse
+            {'name': 'ellipse', 'method': 'draw_ellipse',
+             'when': {'options': [True,False], 'p': [0.3,0.7]}},
+            {'name': 'smooth', 'method': 'smooth_lines'},
+            # 30% Chance of drawing points
+            {'name': 'points', 'method': 'draw_points',
+             'when': {'options': [True,False], 'p': [0.3,0.7]},
+             'args': {'randon_qty': True, 'select_quadrant': {'options': [True,False]}}},
+        ]},
+    'geometric': {
+        'bg_type': {'options': ['light','dark','white','black'], 'p': [0.425,0.425,0.05,0.1]},
+        'stages': [
+            {'name': 'background', 'method': 'alter_background'},
+            # choose 1 line effect
+            {'name': 'line_effect',
+             'method': {'options': ['add_curve_effect','draw_vertical_lines','draw_diagonal_lines','draw_horizontal_lines'],
+                        'p': [0.28,0.24,0.24,0.24]}},
+            # 90% Chance of drawing polygon
+            {'name': 'polygon', 'method': 'draw_regular_polygon',
+             'when': {'options': [True,False], 'p': [0.9,0.1]}},
+            {'name': 'smooth', 'method': 'smooth_lines', 'args': {'random_blur': False}},
+        ]},
+}
+
+
+class _Sampler():
+    """A value of a style spec compiled once: a constant, a choice or an int range
+    * Choices keep the cumulative distribution, so each draw is a single rng.random() and a binary search,
+    the same draw np.random.Generator.choice makes (same seed, same result) without validating p again
+    """
+    
+    
+    def __init__(self, spec):
+        self.constant = spec
+        self.options = self.cdf = self.range = None
+        if isinstance(spec, dict) and 'options' in spec:
+            self.options = list(spec['options'])
+            if spec.get('p') != None:
+                if len(spec['p']) != len(self.options):
+                    raise Exception('options and p must have the same length')
+                self.cdf = _cdf(tuple(spec['p']))
+        elif isinstance(spec, dict) and 'range' in spec:
+            self.range = (int(spec['range'][0]), int(spec['range'][1]))
+    
+    
+    def sample(self, rng):
+        if self.options != None:
+            if self.cdf == None:
+                return self.options[int(rng.integers(0, len(self.options)))]
+            return self.options[bisect.bisect_right(self.cdf, rng.random())]
+        if self.range != None:
+            return int(rng.integers(*self.range))
+        return self.constant
+
+
+class ArtStyle():
+    """An art style compiled from a spec (see STYLE_SPECS), called like create_chaotic_art / create_geometric_art
+    * The spec is validated and its probabilities are compiled once, rendering only draws from the samplers
+    * register_style(name, spec) makes a new style available to generate_batch, iter_art, ArtPool...
+    """
+    
+    
+    def __init__(self, spec:dict, name:str = 'style'):
+        """Keyword arguments:
+        spec -- dict with 'bg_type' and 'stages', see STYLE_SPECS
+        name -- style name, used in traces
+        """
+        self.name = name
+        self.bg_type = _Sampler(spec.get('bg_type', 'white'))
+        self.stages = []
+        for stage in spec['stages']:
+            methods = stage['method']['options'] if isinstance(stage['method'], dict) else [stage['method']]
+            for method in methods:
+                if method.startswith('_') or not callable(getattr(ArtGenerator, method, None)):
+                    raise Exception(str(method) + ' is not an ArtGenerator method')
+            self.stages.append({'name': stage.get('name', str(stage['method'])),
+                                'method': _Sampler(stage['method']),
+                                'when': _Sampler(stage.get('when', True)),
+                                'repeat': _Sampler(stage.get('repeat', 1)),
+                                'args': [(key, _Sampler(value)) for key, value in stage.get('args', {}).items()]})
+    
+    
+    @classmethod
+    def from_file(cls, path:str, name:str = None):
+        """Return the style compiled from a .json or .yaml/.yml spec file (yaml needs PyYAML)"""
+        with open(path) as file:
+            if path.endswith(('.yaml', '.yml')):
+                import yaml
+                spec = yaml.safe_load(file)
             else:
-                self.img.save(first_option_name + '.jpeg' , format='jpeg')
+                spec = json.load(file)
+        return cls(spec, name or os.path.splitext(os.path.basename(path))[0])
+    
+    
+    def run(self, img_size:tuple = (600,400), seed = None, tracer:Tracer = None, stages:int = None, choices:dict = None,
+            **generator_args):
+        """Return the ArtGenerator object after running every stage
+        
+        Keyword arguments:
+        img_size -- 2-d tuple with (x,y) in pixels
+        seed -- seed for the random generator, the same seed always returns the same image (default random)
+        tracer -- Tracer recording one span per stage and per method call (default None, no tracing)
+        stages -- run only the first stages (default all)
+        choices -- if a dict is given, the sampled options are written in it: 'bg_type' and 'calls',
+        a list of {'stage', 'method', 'args'} for each method called
+        generator_args -- other ArtGenerator args (line_backend, smooth_backend, record...)
+        """
+        with _span(tracer, self.name, img_size = img_size):
+            with _span(tracer, 'setup'):
+                # One generator for the whole pipeline, shared with the ArtGenerator object
+                rng = np.random.default_rng(seed)
+                bg_type = self.bg_type.sample(rng)
+                im = ArtGenerator(bg_type = bg_type, img_size = img_size, seed = rng, tracer = tracer, **generator_args)
+            if choices != None:
+                choices.update(bg_type = bg_type, calls = [])
+            self._run_stages(im, self.stages[:stages], choices)
+        return im
+    
+    
+    def _run_stages(self, im:ArtGenerator, stages:list, choices:dict = None):
+        """Run stages on im, drawing from im.rng, the calls are added to choices['calls'] if choices is set"""
+        for stage in stages:
+            with _span(im.tracer, stage['name']):
+                if stage['when'].sample(im.rng) != True:
+                    continue
+                for i in range(stage['repeat'].sample(im.rng)):
+                    method = stage['method'].sample(im.rng)
+                    args = {key: sampler.sample(im.rng) for key, sampler in stage['args']}
+                    if choices != None:
+                        choices['calls'].append({'stage': stage['name'], 'method': method, 'args': args})
+                    getattr(im, method)(**args)
+    
+    
+    def variants(self, n:int, img_size:tuple = (600,400), seed = None, prefix_stages:int = 1, workers:int = None,
+                 record:bool = False, tracer:Tracer = None, **generator_args):
+        """Return n images (or DisplayLists if record=True) that share the same first stages
+        * The prefix (setup + the first prefix_stages stages, e.g. the background) is rendered once and
+        each variant only runs the remaining stages on a copy of it, see ArtGenerator.fan_out
+        * The prefix is the same as the one of the image rendered with seed
+        
+        Keyword arguments:
+        n -- number of variants
+        img_size -- 2-d tuple with (x,y) in pixels
+        seed -- seed of the prefix, the variant seeds are spawned from it (default random)
+        prefix_stages -- number of stages shared by all variants
+        workers -- number of threads (default os.cpu_count())
+        record -- if True return DisplayLists
+        tracer -- Tracer recording spans (default None, no tracing)
+        generator_args -- other ArtGenerator args (line_backend, smooth_backend...)
+        """
+        base = self.run(img_size, seed, tracer, prefix_stages, record = record, **generator_args)
+        variants = base.fan_out(lambda im: self._run_stages(im, self.stages[prefix_stages:]), n, seed, workers)
+        if record == True:
+            return [im.display_list for im in variants]
+        return [im.img if im.quality == 'standard' else im.render() for im in variants]
+    
+    
+    def __call__(self, save_path:str = None, img_size:tuple = (600,400), seed = None, record:bool = False,
+                 tracer:Tracer = None, **generator_args):
+        """Return a random image of this style, see create_chaotic_art"""
+        im = self.run(img_size, seed, tracer, record = record, **generator_args)
+        if record == True:
+            return im.display_list
+        if im.quality != 'standard':
+            with _span(tracer, 'render', quality = im.quality):
+                im.img = im.render()
+        # Save img
+        if save_path != None:
+            with _span(tracer, 'save', path = save_path + '.jpeg'):
+                im.img.save(save_path + '.jpeg', format='jpeg')
+        return im.img
+
+
+_COMPILED_STYLES = {name: ArtStyle(spec, name) for name, spec in STYLE_SPECS.items()}
 
 
-def create_chaotic_art(save_path:str = None,img_size:tuple = (600,400)):
+def create_chaotic_art(save_path:str = None,img_size:tuple = (600,400), seed = None, record:bool = False,
+                       smooth_backend:str = 'pil', tracer:Tracer = None, animation:AnimationRecorder = None,
+                       quality:str = 'standard'):
     """Return a random image with non-geometric features
+    * The style is defined by STYLE_SPECS['chaotic']
         
     Keyword arguments:
     save_path -- path without extension to save image (default dont save)
     img_size -- 2-d tuple with (x,y) in pixels
+    seed -- seed for the random generator, the same seed always returns the same image (default random)
+    record -- if True return the artwork DisplayList instead of the image, render it with .render(size)
+    smooth_backend -- 'pil' or 'numpy', see ArtGenerator (default 'pil')
+    tracer -- Tracer recording one span per stage and per method call (default None, no tracing)
+    animation -- AnimationRecorder receiving a frame after each method call (default None)
+    quality -- 'draft' (half size preview), 'standard' or 'final' (supersampled), see DisplayList.render
     """
+    return _COMPILED_STYLES['chaotic'](save_path, img_size, seed, record, tracer, smooth_backend = smooth_backend,
+                                       animation = animation, quality = quality)
 
-    # p --  probabilities associated with each entry
-    random_type = np.random.choice(['light','dark','white','black'], p = (0.45,0.45,0.05,0.05))
-    im = ArtGenerator(bg_type = random_type, img_size = img_size)
 
-    im.alter_background()
+def create_geometric_art(save_path:str = None, img_size:tuple= (600,400), seed = None, line_backend:str = 'pil', record:bool = False,
+                         smooth_backend:str = 'pil', tracer:Tracer = None, animation:AnimationRecorder = None,
+                         quality:str = 'standard'):
+    """Return a random image with geometric features
+    * The style is defined by STYLE_SPECS['geometric']
+        
+    Keyword arguments:
+    save_path -- path without extension to save image (default dont save)
+    img_size -- 2-d tuple with (x,y) in pixels
+    seed -- seed for the random generator, the same seed always returns the same image (default random)
+    line_backend -- 'pil' or 'numpy', see ArtGenerator (default 'pil')
+    record -- if True return the artwork DisplayList instead of the image, render it with .render(size)
+    smooth_backend -- 'pil' or 'numpy', see ArtGenerator (default 'pil')
+    tracer -- Tracer recording one span per stage and per method call (default None, no tracing)
+    animation -- AnimationRecorder receiving a frame after each method call (default None)
+    quality -- 'draft' (half size preview), 'standard' or 'final' (supersampled), see DisplayList.render
+    """
+    return _COMPILED_STYLES['geometric'](save_path, img_size, seed, record, tracer, line_backend = line_backend,
+                                         smooth_backend = smooth_backend, animation = animation, quality = quality)
+
+
+def _benchmark_smooth(img, blur_factor:float, backend:str, repeat:int):
+    """Run _smooth repeat times on copies of img, returns (best seconds, peak memory growth of the first run, output)
+    * Called in a new process by benchmark_smoothing, so the memory freed by earlier runs can't hide the peak
+    """
+    times = []
+    for i in range(repeat):
+        work = img.copy()
+        _peak_memory(reset = True)
+        start_memory = _peak_memory()
+        start = time.perf_counter()
+        output = _smooth(work, blur_factor, backend)
+        times.append(time.perf_counter() - start)
+        if i == 0:
+            memory = _peak_memory() - start_memory if start_memory != None else None
+        del work
+    return min(times), memory, output
+
+
+def benchmark_smoothing(img_size:tuple = (3840,2160), blur_factors:list = [0.5, 2], repeat:int = 5, seed = 0):
+    """Compare the time and memory of the two smooth_lines backends on the same artwork
+    * Returns a dict blur_factor -> {'pil': seconds, 'numpy': seconds, 'pil_memory': bytes, 'numpy_memory': bytes,
+    'max_diff': levels}, times are the best of repeat runs
+    * Memory is how much the peak resident memory (Pillow buffers included) grows while smoothing, measured on
+    the first run in a new process for each backend (None if the platform has no /proc, see _peak_memory)
+    
+    Keyword arguments:
+    img_size -- 2-d tuple with (x,y) in pixels
+    blur_factors -- BoxBlur radius to test
+    repeat -- number of runs of each backend
+    seed -- seed of the artwork
+    """
     
-    # Draw 1-3 Groups of lines, i.e. lines of same color (1% chance of 0 lines)
-    qty_lines = np.random.choice([1,2,3,0], p = (0.33,0.33,0.33,0.01))
-    for line in range(qty_lines):
-        # Draw a random line
-        im.draw_line(random_qnt_lines = True,
-                     width = np.random.choice([1,5,2,3,4], p = (0.35,0.35,0.1,0.1,0.1)), 
-                     sequential_lines = random.choice([True,False]))
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    base = create_geometric_art(img_size = img_size, seed = seed)
+    results = {}
+    for blur_factor in blur_factors:
+        results[blur_factor] = {}
+        outputs = []
+        for backend in ['pil', 'numpy']:
+            # A spawned process doesn't share the heap of this one (forked, freed pages would be reused)
+            with ProcessPoolExecutor(max_workers = 1, mp_context = multiprocessing.get_context('spawn')) as executor:
+                seconds, memory, img = executor.submit(_benchmark_smooth, base, blur_factor, backend, repeat).result()
+            results[blur_factor][backend] = seconds
+            results[blur_factor][backend + '_memory'] = memory
+            outputs.append(np.asarray(img, dtype = np.int16))
+        results[blur_factor]['max_diff'] = int(np.abs(outputs[0] - outputs[1]).max())
+    return results
 
-    # Draw 1-3 Arcs 1% chance of 0 arcs)
-    qty_arcs = np.random.choice([1,2,3,0], p = (0.33,0.33,0.33,0.01))
-    for arc in range(qty_arcs):
-        # Draw a random line
-        im.draw_arc(fill_arc = random.choice([True,False]))
 
-    # 30% Chance of drawing a ellipse
-    choice = np.random.choice([True, False], p = (0.3,0.7))
-    if choice == True:
-        im.draw_ellipse()
-        
-    # Smooth lines
-    im.smooth_lines()
-            
-    # 30% Chance of drawing points
-    choice = np.random.choice([True, False], p = (0.3,0.7))
-    if choice == True:
-        im.draw_points(randon_qty = True, select_quadrant = random.choice([True,False]))
+def benchmark_polygon_fill(img_size:tuple = (1920,1080), vertex_counts:list = [10**2, 10**3, 10**4, 10**5],
+                           repeat:int = 3, seed = 0, pil_max_vertices:int = 10**4):
+    """Compare the two draw_artistic_polygon fill backends for growing vertex counts
+    * Returns a dict n_vertices -> {'pil': seconds, 'numpy': seconds, 'numpy_per_vertex': seconds},
+    times are the best of repeat runs, numpy_per_vertex stays roughly constant (linear scaling)
 
-    # Save img
+    Keyword arguments:
+    img_size -- 2-d tuple with (x,y) in pixels
+    vertex_counts -- n_vertices to test
+    repeat -- number of runs of each backend
+    seed -- seed of the polygons
+    pil_max_vertices -- 'pil' is skipped (None) above this count, since it grows quadratically
+    """
+
+    results = {}
+    for n_vertices in vertex_counts:
+        results[n_vertices] = {}
+        for backend in ['pil', 'numpy']:
+            if backend == 'pil' and n_vertices > pil_max_vertices:
+                results[n_vertices][backend] = None
+                continue
+            times = []
+            for i in range(repeat):
+                im = ArtGenerator(img_size = img_size, seed = seed)
+                start = time.perf_counter()
+                im.draw_artistic_polygon(n_vertices, fill_backend = backend)
+                times.append(time.perf_counter() - start)
+            results[n_vertices][backend] = min(times)
+        results[n_vertices]['numpy_per_vertex'] = results[n_vertices]['numpy']/n_vertices
+    return results
+
+
+# Predefined art styles, maps style name -> function that creates the artwork
+ART_STYLES = {'chaotic': create_chaotic_art,
+              'geometric': create_geometric_art}
+
+
+def register_style(name:str, spec:dict):
+    """Compile spec (see STYLE_SPECS) and add it to ART_STYLES, so it can be used by generate_batch, iter_art...
+    * With process pools that spawn workers (Windows/macOS) register the style at import time of your script
+    """
+    ART_STYLES[name] = _COMPILED_STYLES[name] = ArtStyle(spec, name)
+    return ART_STYLES[name]
+
+
+def create_variants(style:str = 'geometric', n:int = 10, img_size:tuple = (600,400), seed = None,
+                    prefix_stages:int = 1, workers:int = None, **style_args):
+    """Return n variants of one composition, rendering the shared prefix only once (see ArtStyle.variants)
+    * With the default prefix_stages=1 all the variants have the same background
+    
+    Keyword arguments:
+    style -- 'geometric', 'chaotic' or a registered style
+    n -- number of variants
+    img_size -- 2-d tuple with (x,y) in pixels
+    seed -- seed of the shared prefix, the variant seeds are spawned from it (default random)
+    prefix_stages -- number of stages of the style shared by all variants
+    workers -- number of threads (default os.cpu_count())
+    style_args -- other args (record, tracer, line_backend, smooth_backend)
+    """
+    if style not in _COMPILED_STYLES:
+        raise Exception('style must be ' + ' or '.join(_COMPILED_STYLES))
+    return _COMPILED_STYLES[style].variants(n, img_size, seed, prefix_stages, workers, **style_args)
+
+
+def _encode_jpeg(img, save_path:str = None):
+    """Return img encoded as jpeg bytes, or save it and return the file path if save_path is set"""
     if save_path != None:
-        im.img.save(save_path + '.jpeg', format='jpeg')
+        img.save(save_path, format='jpeg')
+        return save_path
+    return encode_image(img)['data']
 
-    return im.img
 
+def _render_task(style:str, img_size:tuple, seed, save_path:str = None):
+    """Render one artwork in a worker process and return it as jpeg bytes,
+    or save it and return the file path if save_path is set (so the image itself is never pickled)
+    """
+    img = ART_STYLES[style](img_size = img_size, seed = seed)
+    return _encode_jpeg(img, save_path)
+
+
+def generate_batch(style:str = 'geometric', n:int = 10, img_size:tuple = (600,400), workers:int = None,
+                   base_seed = None, out_dir:str = None):
+    """Render n artworks in parallel with a process pool
+    * Each image gets its own independent seed stream spawned from base_seed,
+    so the same base_seed always returns the same batch regardless of the number of workers
+    * Images are returned as jpeg bytes or written straight to out_dir, never as PIL objects
+    * On platforms that spawn processes (Windows/macOS) call it under if __name__ == '__main__'
 
-def create_geometric_art(save_path:str = None, img_size:tuple= (600,400)):
-    """Return a random image with geometric features
-        
     Keyword arguments:
-    save_path -- path without extension to save image (default dont save)
+    style -- 'geometric' or 'chaotic'
+    n -- number of images
+    img_size -- 2-d tuple with (x,y) in pixels
+    workers -- number of processes (default os.cpu_count())
+    base_seed -- seed used to spawn one seed per image (default random)
+    out_dir -- if set, images are saved as out_dir/<style>_<index>.jpeg and the paths are returned
+    """
+
+    if style not in ART_STYLES:
+        raise Exception('style must be ' + ' or '.join(ART_STYLES))
+
+    seeds = np.random.SeedSequence(base_seed).spawn(n)
+    if out_dir != None:
+        os.makedirs(out_dir, exist_ok = True)
+        paths = [os.path.join(out_dir, style + '_' + str(i) + '.jpeg') for i in range(n)]
+    else:
+        paths = [None]*n
+
+    if workers == None:
+        workers = os.cpu_count() or 1
+    # Send tasks in chunks to reduce inter-process overhead
+    chunksize = max(1, n // (workers*4))
+    # Imported here, like the other modules only some functions need, to keep the import of this module fast
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+        return list(executor.map(_render_task, [style]*n, [img_size]*n, seeds, paths, chunksize = chunksize))
+
+
+def _copy_pixels(img, out):
+    """Write the pixels of an RGB image into out, a C-contiguous uint8 array (height, width, 3)
+    * PIL stores RGB pixels padded to 4 bytes, so they must be unpacked once: the raw encoder
+    (the one behind tobytes) unpacks small blocks that are copied into out, without building
+    the whole image as bytes first
+    """
+    encoder = Image._getencoder('RGB', 'raw', 'RGB')
+    encoder.setimage(img.im, (0, 0) + img.size)
+    flat = out.reshape(-1)
+    position = 0
+    while True:
+        consumed, errcode, data = encoder.encode(max(65536, img.size[0]*4))
+        flat[position:position + len(data)] = np.frombuffer(data, dtype = np.uint8)
+        position += len(data)
+        if errcode:
+            break
+    if errcode < 0:
+        raise Exception('encoder error ' + str(errcode) + ' while copying pixels')
+
+
+def _render_with_metadata(style:str, img_size:tuple, seed_seq, index:int):
+    """Render an artwork with seed_seq (SeedSequence), return (image, metadata dict)
+    * metadata has the index, style, img_size, the 'seed' ({'entropy', 'spawn_key'}, the image is rendered
+    again with np.random.SeedSequence(entropy, spawn_key = spawn_key)) and, for styles made from a spec,
+    the 'bg_type' and the 'calls' (stage, method and args) chosen by the style
+    """
+    choices = {}
+    if style in _COMPILED_STYLES:
+        img = _COMPILED_STYLES[style].run(img_size, seed_seq, choices = choices).img
+    else:
+        img = ART_STYLES[style](img_size = img_size, seed = seed_seq)
+    metadata = {'index': index, 'style': style, 'img_size': list(img_size),
+                'seed': {'entropy': seed_seq.entropy, 'spawn_key': list(seed_seq.spawn_key)}}
+    metadata.update(choices)
+    return img, metadata
+
+
+def render_batch_array(style:str = 'geometric', n:int = 10, img_size:tuple = (600,400), seed = None,
+                       out = None, path:str = None, workers:int = None):
+    """Render n artworks straight into one uint8 array (n, height, width, 3), returns (array, metadata)
+    * Each image is unpacked once from the PIL image into its slot of the array, there are no
+    per-image arrays to stack
+    * Each image gets its own seed spawned from seed, the same way as in generate_batch and iter_art,
+    so the batch has the same images for the same seed
+    * metadata[i] is a dict with the 'seed' of image i ({'entropy', 'spawn_key'}, the image is rendered
+    again with np.random.SeedSequence(entropy, spawn_key = spawn_key)), its 'bg_type' and the
+    'calls' (stage, method and args) chosen by the style
+    * Images are rendered by a thread pool, each thread writes its own slots
+
+    Keyword arguments:
+    style -- name of a style in ART_STYLES
+    n -- number of images
+    img_size -- 2-d tuple with (x,y) in pixels
+    seed -- seed used to spawn one seed per image (default random)
+    out -- array (n, height, width, 3) of uint8 to write into, e.g. a slice of a larger dataset (default a new array)
+    path -- if set (.npy), out is a new memory-mapped file, open it later with np.load(path, mmap_mode='r')
+    workers -- number of threads (default os.cpu_count(), 1 renders in the calling thread)
+    """
+
+    if style not in ART_STYLES:
+        raise Exception('style must be ' + ' or '.join(ART_STYLES))
+    shape = (n, img_size[1], img_size[0], 3)
+    if out is None:
+        if path != None:
+            out = np.lib.format.open_memmap(path, mode = 'w+', dtype = np.uint8, shape = shape)
+        else:
+            out = np.empty(shape, dtype = np.uint8)
+    elif out.shape != shape or out.dtype != np.uint8 or out.flags['C_CONTIGUOUS'] == False:
+        raise Exception('out must be a C-contiguous uint8 array with shape ' + str(shape))
+
+    seeds = np.random.SeedSequence(seed).spawn(n)
+    metadata = [None]*n
+
+    def render(i):
+        img, metadata[i] = _render_with_metadata(style, img_size, seeds[i], i)
+        _copy_pixels(img, out[i])
+
+    if workers == 1:
+        for i in range(n):
+            render(i)
+    else:
+        with ThreadPoolExecutor(max_workers = workers or os.cpu_count() or 1) as executor:
+            for future in [executor.submit(render, i) for i in range(n)]:
+                future.result()
+    if path != None:
+        out.flush()
+    return out, metadata
+
+
+def _render_unique(style:str, img_size:tuple, seed_seq, unique_index = None, max_rerolls:int = 10):
+    """Render an artwork with the next seed spawned from seed_seq
+    * If unique_index (UniquenessIndex) is set, near-duplicates of indexed images are re-rolled with a new seed,
+    up to max_rerolls times (the last one is kept), and the image is added to the index
+    """
+    for i in range(max_rerolls + 1):
+        img = ART_STYLES[style](img_size = img_size, seed = seed_seq.spawn(1)[0])
+        if unique_index == None or unique_index.add(img, force = i == max_rerolls):
+            return img
+
+
+def iter_art(style:str = 'geometric', count:int = None, img_size:tuple = (600,400), seed = None,
+             encode:bool = True, out_dir:str = None, encode_workers:int = 2, max_pending:int = 4,
+             unique_index = None, max_rerolls:int = 10):
+    """Lazily yield artworks one at a time
+    * Images are rendered in the calling thread while jpeg encoding and disk writes run on a thread pool,
+    so rendering the next image overlaps with encoding the previous ones
+    * At most max_pending images are waiting to be encoded, so the memory used is constant
+    regardless of count
+    * Each image gets its own seed spawned from seed, the same way as in generate_batch,
+    so both functions return the same images for the same seed
+
+    Keyword arguments:
+    style -- 'geometric' or 'chaotic'
+    count -- number of images (default None, never stops)
     img_size -- 2-d tuple with (x,y) in pixels
+    seed -- seed used to spawn one seed per image (default random)
+    encode -- if True yield jpeg bytes, if False yield PIL images (no thread pool is used)
+    out_dir -- if set, images are saved as out_dir/<style>_<index>.jpeg and the paths are yielded
+    encode_workers -- number of threads encoding/saving images
+    max_pending -- max number of rendered images waiting to be encoded
+    unique_index -- UniquenessIndex, if set near-duplicates of indexed images are re-rolled (with new seeds)
+    and every yielded image is added to it
+    max_rerolls -- max number of re-rolls of one image, after that the near-duplicate is kept
     """
 
-    # p --  probabilities associated with each entry
-    random_type = np.random.choice(['light','dark','white','black'], p = (0.425,0.425,0.05,0.1))
-    im = ArtGenerator(bg_type = random_type, img_size = img_size)
+    if style not in ART_STYLES:
+        raise Exception('style must be ' + ' or '.join(ART_STYLES))
+
+    seed_seq = np.random.SeedSequence(seed)
+    indexes = itertools.count() if count == None else range(count)
+    if out_dir != None:
+        os.makedirs(out_dir, exist_ok = True)
+
+    # Only rendering, nothing to do in background
+    if encode == False and out_dir == None:
+        for i in indexes:
+            yield _render_unique(style, img_size, seed_seq, unique_index, max_rerolls)
+        return
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers = encode_workers) as executor:
+        try:
+            for i in indexes:
+                img = _render_unique(style, img_size, seed_seq, unique_index, max_rerolls)
+                save_path = None if out_dir == None else os.path.join(out_dir, style + '_' + str(i) + '.jpeg')
+                pending.append(executor.submit(_encode_jpeg, img, save_path))
+                del img
+                # Queue is full, wait for the oldest image before rendering the next one
+                if len(pending) >= max_pending:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # Generator closed early, drop the images not yet encoded
+            for future in pending:
+                future.cancel()
+
 
-    im.alter_background()
-    # choose 1 line effect 
-    effect_choice = np.random.choice(['curve','vertical','diagonal','horizontal'], p = (0.28,0.24,0.24,0.24))
+class ArtPool():
+    """A pool of pre-rendered and pre-encoded artworks, one queue per (style, img_size)
+    * Background threads keep every queue filled up to pool_size, so get() usually just pops bytes
+    * A size requested for the first time is rendered on the spot (miss) and added to the pool
+    * Each pooled image is rendered with a random seed that is returned with it, so it can be rebuilt later
+    """
+    
+    
+    def __init__(self, sizes:list = [(600,400)], styles:list = None, pool_size:int = 8, workers:int = 2,
+                 format:str = 'jpeg', max_keys:int = 64):
+        """Keyword arguments:
+        sizes -- img_size values warmed from the start
+        styles -- styles warmed from the start (default all ART_STYLES)
+        pool_size -- images kept ready for each (style, img_size)
+        workers -- number of background threads refilling the pool
+        format -- 'jpeg', 'png' or 'webp'
+        max_keys -- max number of (style, img_size) queues, new sizes beyond it are not pooled
+        """
+        if styles == None:
+            styles = list(ART_STYLES)
+        self.pool_size = pool_size
+        self.format = format
+        self.max_keys = max_keys
+        # (style, img_size) -> deque of (seed, encoded bytes)
+        self.queues = {}
+        # (style, img_size) -> images being rendered by the background threads
+        self._rendering = {}
+        self.counters = {'hits': 0, 'misses': 0, 'refills': 0}
+        self.start_time = time.perf_counter()
+        self._condition = threading.Condition()
+        self._stop = False
+        with self._condition:
+            for style in styles:
+                for size in sizes:
+                    self._add_key(style, tuple(size))
+        self._threads = [threading.Thread(target = self._refill, daemon = True) for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+    
     
-    if effect_choice == 'curve':
-        im.add_curve_effect()
-    elif effect_choice == 'vertical':
-        im.draw_vertical_lines()
-    elif effect_choice == 'diagonal':
-        im.draw_diagonal_lines()
-    elif effect_choice == 'horizontal':
-        im.draw_horizontal_lines()
+    def _add_key(self, style:str, img_size:tuple):
+        """Create the queue of (style, img_size) if there is room, must be called holding self._condition"""
+        if (style, img_size) not in self.queues and len(self.queues) < self.max_keys:
+            self.queues[(style, img_size)] = deque()
+            self._rendering[(style, img_size)] = 0
+            self._condition.notify_all()
+    
+    
+    def _render(self, style:str, img_size:tuple, seed:int):
+        """Return the encoded bytes of one artwork"""
+        return encode_image(ART_STYLES[style](img_size = img_size, seed = seed), self.format)['data']
+    
+    
+    def _refill(self):
+        """Background loop, renders images for the emptiest queue until close() is called"""
+        while True:
+            with self._condition:
+                while not self._stop:
+                    missing = [(len(queue) + self._rendering[key], key) for key, queue in self.queues.items()
+                               if len(queue) + self._rendering[key] < self.pool_size]
+                    if missing:
+                        key = min(missing)[1]
+                        self._rendering[key] += 1
+                        break
+                    self._condition.wait()
+                if self._stop:
+                    return
+            seed = np.random.SeedSequence().entropy
+            try:
+                data = self._render(key[0], key[1], seed)
+            finally:
+                with self._condition:
+                    self._rendering[key] -= 1
+            with self._condition:
+                self.queues[key].append((seed, data))
+                self.counters['refills'] += 1
+    
+    
+    def get(self, style:str = 'geometric', img_size:tuple = (600,400), seed = None):
+        """Return (seed, encoded bytes) of an artwork
+        * With seed set the image is always rendered (it can't come from the pool)
+        
+        Keyword arguments:
+        style -- 'geometric' or 'chaotic'
+        img_size -- 2-d tuple with (x,y) in pixels
+        seed -- int seed (default random image from the pool)
+        """
+        if style not in ART_STYLES:
+            raise Exception('style must be ' + ' or '.join(ART_STYLES))
+        img_size = tuple(img_size)
+        if seed == None:
+            with self._condition:
+                queue = self.queues.get((style, img_size))
+                if queue:
+                    self.counters['hits'] += 1
+                    item = queue.popleft()
+                    self._condition.notify()
+                    return item
+                self.counters['misses'] += 1
+                self._add_key(style, img_size)
+            seed = np.random.SeedSequence().entropy
+        return seed, self._render(style, img_size, seed)
+    
+    
+    def stats(self):
+        """Return the hit/miss/refill counters, the refill rate (images/s) and the pooled images per queue"""
+        with self._condition:
+            stats = dict(self.counters)
+            stats['refill_rate'] = stats['refills']/(time.perf_counter() - self.start_time)
+            stats['pooled'] = {style + ' ' + str(size[0]) + 'x' + str(size[1]): len(queue)
+                               for (style, size), queue in self.queues.items()}
+        return stats
+    
+    
+    def close(self):
+        """Stop the background threads"""
+        with self._condition:
+            self._stop = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
 
-    # 90% Chance of drawing polygon
-    polygon_draw = np.random.choice([True,False], p = (0.9,0.1))
-    if polygon_draw == True:
-        im.draw_regular_polygon()
+def serve_art(host:str = '127.0.0.1', port:int = 8000, pool:ArtPool = None, max_pixels:int = 3840*2160):
+    """Run a local HTTP server (blocking) that serves artworks from an ArtPool
+    * GET /art/<style>?w=&h=&seed= returns one image, the seed used is sent in the X-Art-Seed header
+    * GET /stats returns the pool counters as json
     
+    Keyword arguments:
+    host -- address to listen on
+    port -- port to listen on
+    pool -- ArtPool used (default ArtPool with 600x400 images)
+    max_pixels -- requests with w*h above it are refused
+    """
+    
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import urlparse, parse_qs
     
-    # Smooth lines
-    im.smooth_lines(random_blur = False)
+    if pool == None:
+        pool = ArtPool()
+    content_type = 'image/' + IMAGE_FORMATS[pool.format]
+    
+    class ArtHandler(BaseHTTPRequestHandler):
+        
+        def _send(self, code:int, body:bytes, content_type:str, headers:dict = {}):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == '/stats':
+                return self._send(200, json.dumps(pool.stats()).encode(), 'application/json')
+            match = re.fullmatch('/art/(\\w+)', url.path)
+            if match == None or match.group(1) not in ART_STYLES:
+                return self._send(404, b'unknown style', 'text/plain')
+            query = parse_qs(url.query)
+            try:
+                img_size = (int(query.get('w', [600])[0]), int(query.get('h', [400])[0]))
+                seed = int(query['seed'][0]) if 'seed' in query else None
+            except ValueError:
+                return self._send(400, b'w, h and seed must be integers', 'text/plain')
+            if min(img_size) < 1 or img_size[0]*img_size[1] > max_pixels:
+                return self._send(400, b'invalid size', 'text/plain')
+            if seed != None and seed < 0:
+                return self._send(400, b'seed must be a non-negative integer', 'text/plain')
+            try:
+                seed, data = pool.get(match.group(1), img_size, seed)
+            except Exception:
+                # The client always gets an answer, the server keeps running
+                return self._send(500, b'render failed', 'text/plain')
+            self._send(200, data, content_type, {'X-Art-Seed': str(seed)})
+        
+        def log_message(self, format, *args):
+            pass
+    
+    server = ThreadingHTTPServer((host, port), ArtHandler)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        pool.close()
 
-    # Save img  
-    if save_path != None:
-        im.img.save(save_path + '.jpeg', format='jpeg')
 
-    return im.img
+def perceptual_hash(img, hash_size:int = 8):
+    """Return the difference hash (dHash) of img as an int of hash_size*hash_size bits
+    * The image is reduced to (hash_size+1, hash_size) in grayscale and each bit tells if a pixel is
+    brighter than its right neighbour, so near-duplicate images have hashes with a small Hamming distance
+    
+    Keyword arguments:
+    img -- PIL image
+    hash_size -- the hash has hash_size**2 bits (default 64 bits)
+    """
+    pixels = np.asarray(img.convert('L').resize((hash_size + 1, hash_size), Image.BOX), dtype = np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int(np.packbits(bits).view('>u8')[0]) if hash_size == 8 else int(''.join('1' if b else '0' for b in bits), 2)
+
+
+# Number of 1 bits of each byte value
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype = np.uint8)
+
 
+def _hamming(hashes, value:int):
+    """Return the Hamming distance between each uint64 of hashes and value"""
+    xor = np.bitwise_xor(hashes, np.uint64(value))
+    return _POPCOUNT_TABLE[xor.view(np.uint8)].reshape(-1, 8).sum(axis = 1)
 
+
+def _chunk_count(n_hashes:int, max_distance:int):
+    """Return the number of chunks that makes a lookup of a segment of n_hashes cheapest
+    * With m chunks two hashes at distance <= max_distance have a chunk at distance <= max_distance//m
+    (pigeonhole principle), each chunk is probed with every key at that distance of the query chunk
+    * Few wide chunks mean many probes but few candidates per probe, the best chunks have ~log2(n_hashes) bits
+    """
+    costs = []
+    for n_chunks in range(1, max_distance + 2):
+        width, radius = 64//n_chunks, max_distance//n_chunks
+        probes = sum(math.comb(width, k) for k in range(radius + 1))
+        costs.append((n_chunks*probes*(1 + n_hashes/2.0**width), n_chunks))
+    return min(costs)[1]
+
+
+class _HashSegment():
+    """An immutable group of 64 bit hashes indexed for Hamming range queries (multi-index hashing)
+    * The hashes are split in bit chunks (see _chunk_count), a hash at distance <= max_distance of the query
+    has at least one chunk at distance <= max_distance//n_chunks of the query chunk, so only the hashes
+    whose chunk is one of these keys are compared
+    * Each chunk is kept as a sorted array, the keys are found with a single vectorized binary search
+    """
+    
+    
+    def __init__(self, hashes, max_distance:int):
+        self.hashes = np.asarray(hashes, dtype = np.uint64)
+        self.max_distance = max_distance
+        n_chunks = _chunk_count(len(self.hashes), max_distance)
+        radius = max_distance//n_chunks
+        self.shifts = [64*i//n_chunks for i in range(n_chunks)]
+        widths = [64*(i+1)//n_chunks - self.shifts[i] for i in range(n_chunks)]
+        self.masks = [np.uint64((1 << width) - 1) for width in widths]
+        # Bits flipped to get every key at distance <= radius of a chunk
+        self.flips = [np.array([sum(1 << bit for bit in bits) for k in range(radius + 1)
+                                for bits in itertools.combinations(range(width), k)], dtype = np.uint64)
+                      for width in widths]
+        self.chunks = []
+        for shift, mask in zip(self.shifts, self.masks):
+            keys = (self.hashes >> np.uint64(shift)) & mask
+            order = np.argsort(keys, kind = 'stable')
+            self.chunks.append((keys[order], order))
+    
+    
+    def find(self, value:int):
+        """Return the hashes at Hamming distance <= max_distance of value"""
+        candidates = []
+        for shift, mask, flips, (keys, order) in zip(self.shifts, self.masks, self.flips, self.chunks):
+            probes = ((np.uint64(value) >> np.uint64(shift)) & mask) ^ flips
+            starts, ends = np.searchsorted(keys, probes, side = 'left'), np.searchsorted(keys, probes, side = 'right')
+            counts = ends - starts
+            # Positions of all the matching ranges at once
+            positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)
+            candidates.append(order[positions])
+        candidates = self.hashes[np.unique(np.concatenate(candidates))]
+        return candidates[_hamming(candidates, value) <= self.max_distance]
+
+
+class UniquenessIndex():
+    """An index of perceptual hashes used to detect near-duplicate artworks
+    * Lookups use multi-index hashing over a few sorted segments (merged like a binary counter), the chunks of
+    each segment are sized to its number of hashes, so lookups stay under a millisecond with tens of millions
+    of uniformly spread hashes (clustered hashes give more candidates to compare). Memory is 8 bytes per hash
+    plus 16 bytes per hash per chunk (1-5 chunks)
+    * New hashes wait in a small buffer before being indexed, so adding is cheap
+    * save(path) / UniquenessIndex.load(path) persist the index as a .npz file
+    """
+    
+    
+    def __init__(self, max_distance:int = 4, buffer_size:int = 1024):
+        """Keyword arguments:
+        max_distance -- hashes at Hamming distance <= max_distance are near-duplicates
+        buffer_size -- number of hashes kept unindexed before building a new segment
+        """
+        self.max_distance = max_distance
+        self.buffer_size = buffer_size
+        self.segments = []
+        self.buffer = []
+    
+    
+    def __len__(self):
+        return len(self.buffer) + sum(len(segment.hashes) for segment in self.segments)
+    
+    
+    def find(self, value):
+        """Return the indexed hashes near value (an int hash or a PIL image)"""
+        if isinstance(value, Image.Image):
+            value = perceptual_hash(value)
+        found = [segment.find(value) for segment in self.segments]
+        if self.buffer:
+            buffer = np.array(self.buffer, dtype = np.uint64)
+            found.append(buffer[_hamming(buffer, value) <= self.max_distance])
+        return [int(h) for h in np.concatenate(found)] if found else []
+    
+    
+    def add(self, value, force:bool = False):
+        """Add value (an int hash or a PIL image) and return True, or return False without adding it
+        if it is a near-duplicate of an indexed hash
+        
+        Keyword arguments:
+        value -- int hash or PIL image
+        force -- if True always add it
+        """
+        if isinstance(value, Image.Image):
+            value = perceptual_hash(value)
+        if force == False and self.find(value):
+            return False
+        self.buffer.append(value)
+        if len(self.buffer) >= self.buffer_size:
+            self._flush()
+        return True
+    
+    
+    def _flush(self):
+        """Index the buffer as a new segment, merging the last segments while they are not bigger"""
+        hashes = np.array(self.buffer, dtype = np.uint64)
+        self.buffer = []
+        while self.segments and len(self.segments[-1].hashes) <= len(hashes):
+            hashes = np.concatenate([self.segments.pop().hashes, hashes])
+        self.segments.append(_HashSegment(hashes, self.max_distance))
+    
+    
+    def save(self, path:str):
+        """Save all hashes and settings to path, returns the path (.npz is added if path has no extension .npz)"""
+        if not path.endswith('.npz'):
+            path += '.npz'
+        hashes = [segment.hashes for segment in self.segments] + [np.array(self.buffer, dtype = np.uint64)]
+        np.savez(path, hashes = np.concatenate(hashes), max_distance = self.max_distance, buffer_size = self.buffer_size)
+        return path
+    
+    
+    @classmethod
+    def load(cls, path:str):
+        """Return the index saved in path (.npz is added if path has no extension .npz, like save)"""
+        if not path.endswith('.npz'):
+            path += '.npz'
+        with np.load(path) as data:
+            index = cls(int(data['max_distance']), int(data['buffer_size']))
+            if len(data['hashes']):
+                index.segments.append(_HashSegment(data['hashes'], index.max_distance))
+        return index
+
+
+class _ByteLRU():
+    """A thread-safe LRU cache of bytes values bounded by the total size of the values"""
+    
+    
+    def __init__(self, max_bytes:int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.items = OrderedDict()
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._lock = threading.Lock()
+    
+    
+    def get(self, key):
+        """Return the value of key (None if not cached) and mark it as the most recently used"""
+        with self._lock:
+            value = self.items.get(key)
+            if value == None:
+                self.counters['misses'] += 1
+                return None
+            self.counters['hits'] += 1
+            self.items.move_to_end(key)
+            return value
+    
+    
+    def put(self, key, value:bytes):
+        """Add value, evicting the least recently used values until the cache fits in max_bytes
+        * A value larger than max_bytes is not cached
+        """
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self.items:
+                self.size -= len(self.items.pop(key))
+            self.items[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                self.size -= len(self.items.popitem(last = False)[1])
+                self.counters['evictions'] += 1
+    
+    
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters, items = len(self.items), bytes = self.size, max_bytes = self.max_bytes)
+        requests = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits']/requests if requests else 0.0
+        return stats
+
+
+class ArtCatalog():
+    """A catalog of artworks stored as the few values needed to render them again, instead of the images
+    * Each artwork is a row of a SQLite table: id, style, img_size, seed and the module __version__
+    (a few dozen bytes instead of hundreds of KB for a jpeg), the same seed always renders the same image
+    * render(id) renders the image on demand and keeps the encoded bytes in an LRU cache bounded by
+    cache_bytes, so hot artworks are served from memory
+    * Artworks added by another version of the module can't be rendered, their images may be different
+    * Can be shared by threads
+    """
+    
+    
+    def __init__(self, path:str = 'catalog.sqlite', cache_bytes:int = 64*2**20, format:str = 'jpeg'):
+        """Keyword arguments:
+        path -- SQLite database file, created if it doesn't exist (':memory:' for a temporary catalog)
+        cache_bytes -- max total size of the encoded images kept in memory
+        format -- 'jpeg', 'png' or 'webp'
+        """
+        if format not in IMAGE_FORMATS:
+            raise Exception('format must be ' + ', '.join(IMAGE_FORMATS))
+        self.path = path
+        self.format = format
+        self.cache = _ByteLRU(cache_bytes)
+        self._lock = threading.Lock()
+        import sqlite3
+        self._connection = sqlite3.connect(path, check_same_thread = False)
+        with self._lock, self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS artworks (id INTEGER PRIMARY KEY, style TEXT NOT NULL, '
+                                     'width INTEGER NOT NULL, height INTEGER NOT NULL, seed TEXT NOT NULL, '
+                                     'version TEXT NOT NULL)')
+    
+    
+    @staticmethod
+    def _seed_text(seed):
+        """Return seed as json text, an int or [entropy, spawn_key] for a SeedSequence (None draws a random int)"""
+        if seed == None:
+            seed = np.random.SeedSequence().entropy
+        if isinstance(seed, np.random.SeedSequence):
+            return json.dumps([seed.entropy, list(seed.spawn_key)], separators = (',', ':'))
+        return json.dumps(int(seed))
+    
+    
+    def add(self, style:str = 'geometric', img_size:tuple = (600,400), seed = None):
+        """Add an artwork and return its id
+        
+        Keyword arguments:
+        style -- name of a style in ART_STYLES
+        img_size -- 2-d tuple with (x,y) in pixels
+        seed -- int or np.random.SeedSequence (default random int)
+        """
+        return self.add_many(style, img_size, [seed])[0]
+    
+    
+    def add_many(self, style:str = 'geometric', img_size:tuple = (600,400), seeds:list = None, n:int = None):
+        """Add many artworks of the same style and size in a single transaction, return their ids
+        
+        Keyword arguments:
+        style -- name of a style in ART_STYLES
+        img_size -- 2-d tuple with (x,y) in pixels
+        seeds -- list of int or np.random.SeedSequence
+        n -- if seeds is None, number of artworks with random seeds
+        """
+        if style not in ART_STYLES:
+            raise Exception('style must be ' + ' or '.join(ART_STYLES))
+        if seeds == None:
+            seeds = [None]*n
+        rows = [(style, int(img_size[0]), int(img_size[1]), self._seed_text(seed), __version__) for seed in seeds]
+        with self._lock, self._connection:
+            cursor = self._connection.cursor()
+            ids = []
+            # executemany doesn't return the ids, a single transaction keeps the inserts fast anyway
+            for row in rows:
+                cursor.execute('INSERT INTO artworks (style, width, height, seed, version) VALUES (?,?,?,?,?)', row)
+                ids.append(cursor.lastrowid)
+        return ids
+    
+    
+    def get(self, artwork_id:int):
+        """Return the catalog entry of an artwork as a dict (style, img_size, seed, version)"""
+        with self._lock:
+            row = self._connection.execute('SELECT style, width, height, seed, version FROM artworks WHERE id = ?',
+                                           (int(artwork_id),)).fetchone()
+        if row == None:
+            raise Exception('artwork ' + str(artwork_id) + ' is not in the catalog')
+        seed = json.loads(row[3])
+        if isinstance(seed, list):
+            seed = np.random.SeedSequence(seed[0], spawn_key = seed[1])
+        return {'id': int(artwork_id), 'style': row[0], 'img_size': (row[1], row[2]), 'seed': seed, 'version': row[4]}
+    
+    
+    def image(self, artwork_id:int):
+        """Render an artwork and return it as a PIL image (not cached)"""
+        entry = self.get(artwork_id)
+        if entry['version'] != __version__:
+            raise Exception('artwork ' + str(artwork_id) + ' was added by version ' + entry['version'] +
+                            ', this module renders version ' + __version__)
+        return ART_STYLES[entry['style']](img_size = entry['img_size'], seed = entry['seed'])
+    
+    
+    def render(self, artwork_id:int):
+        """Return the encoded bytes of an artwork, from the cache or rendered on demand"""
+        data = self.cache.get(int(artwork_id))
+        if data == None:
+            data = encode_image(self.image(artwork_id), self.format)['data']
+            self.cache.put(int(artwork_id), data)
+        return data
+    
+    
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM artworks').fetchone()[0]
+    
+    
+    def stats(self):
+        """Return the cache stats (hits, misses, evictions, hit_rate, items, bytes) and the number of artworks"""
+        return dict(self.cache.stats(), artworks = len(self))
+    
+    
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def _write_atomic(path:str, data:bytes):
+    """Write data to path through a temporary file renamed at the end, so path is never partially written"""
+    with open(path + '.tmp', 'wb') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + '.tmp', path)
+
+
+class ShardWriter():
+    """Write records (a few files sharing a key, e.g. an image and its json sidecar) to size-bounded tar shards
+    * Shards follow the WebDataset layout: <prefix>-000000.tar, <prefix>-000001.tar... with the files of a record
+    next to each other as <key>.<extension>, so they can be read by tar, WebDataset or ShardReader
+    * Writes are sequential and buffered, a shard is written to <name>.tar.tmp and renamed once it is complete
+    (after fsync), so a crashed job never leaves a corrupt .tar, only a .tmp that is removed by the next writer
+    * Each shard has an index <name>.tar.idx (json key -> extension -> [offset, size]) to read any record
+    with a single seek, and <prefix>-manifest.json lists the finished shards
+    * A prefix must be used by a single writer at a time
+    """
+    
+    
+    def __init__(self, directory:str, prefix:str = 'shard', max_bytes:int = 256*2**20, buffer_size:int = 2**20):
+        """Keyword arguments:
+        directory -- folder of the shards, created if it doesn't exist
+        prefix -- name of the shards
+        max_bytes -- max size of a shard, tar pads the end of the file to a multiple of 10 KB on top of it
+        (a record larger than it gets a shard of its own)
+        buffer_size -- write buffer size in bytes
+        """
+        os.makedirs(directory, exist_ok = True)
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.buffer_size = buffer_size
+        self.manifest_path = os.path.join(directory, prefix + '-manifest.json')
+        self.manifest = {'shards': [], 'records': 0}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as file:
+                self.manifest = json.load(file)
+        # Leftovers of a crashed writer
+        for name in os.listdir(directory):
+            if name.startswith(prefix + '-') and name.endswith('.tmp'):
+                os.remove(os.path.join(directory, name))
+        self._file = self._tar = None
+    
+    
+    def _open_shard(self):
+        import tarfile
+        name = self.prefix + '-' + str(len(self.manifest['shards'])).zfill(6) + '.tar'
+        self._path = os.path.join(self.directory, name)
+        self._file = open(self._path + '.tmp', 'wb', buffering = self.buffer_size)
+        self._tar = tarfile.open(fileobj = self._file, mode = 'w', format = tarfile.USTAR_FORMAT)
+        self._index = {}
+    
+    
+    def write(self, key:str, files:dict):
+        """Append a record to the current shard, a new shard is started if it doesn't fit
+        
+        Keyword arguments:
+        key -- unique name of the record (without '.')
+        files -- dict extension -> bytes, dict values are stored as json, e.g. {'jpeg': data, 'json': metadata}
+        """
+        if '.' in key or len(key) + max(len(extension) for extension in files) >= 99:
+            raise Exception("key must be shorter than 90 characters and have no '.'")
+        files = {extension: json.dumps(data).encode() if isinstance(data, dict) else data
+                 for extension, data in files.items()}
+        # Each file takes a 512 bytes header and its data padded to 512 bytes, the end of the tar 2 blocks
+        size = sum(512 + -(-len(data)//512)*512 for data in files.values()) + 1024
+        if self._tar != None and self._index and self._tar.offset + size > self.max_bytes:
+            self._finish_shard()
+        if self._tar == None:
+            self._open_shard()
+        self._index[key] = {}
+        for extension, data in files.items():
+            # TarInfo class of the open archive, tarfile is only imported once in _open_shard
+            info = self._tar.tarinfo(key + '.' + extension)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            # USTAR headers take one block, the data starts right after it
+            self._index[key][extension] = [self._tar.offset + 512, len(data)]
+            self._tar.addfile(info, io.BytesIO(data))
+    
+    
+    def _finish_shard(self):
+        """Close the current shard, make it visible with an atomic rename and add it to the manifest"""
+        self._tar.close()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        _write_atomic(self._path + '.idx', json.dumps(self._index).encode())
+        os.replace(self._path + '.tmp', self._path)
+        self.manifest['shards'].append({'path': os.path.basename(self._path), 'records': len(self._index),
+                                        'bytes': os.path.getsize(self._path)})
+        self.manifest['records'] += len(self._index)
+        _write_atomic(self.manifest_path, json.dumps(self.manifest, indent = 1).encode())
+        self._file = self._tar = None
+    
+    
+    def close(self):
+        """Finish the current shard, returns the manifest"""
+        if self._tar != None:
+            self._finish_shard()
+        return self.manifest
+    
+    
+    def abort(self):
+        """Drop the current shard (its records are lost), the finished shards are kept"""
+        if self._tar != None:
+            self._file.close()
+            # Already removed if the prefix was dropped by someone else (e.g. a JobQueue unit done by another worker)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._path + '.tmp')
+            self._file = self._tar = None
+    
+    
+    def __enter__(self):
+        return self
+    
+    
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ShardReader():
+    """Random access to the records of a shard written by ShardWriter, using its index"""
+    
+    
+    def __init__(self, path:str):
+        """Keyword arguments:
+        path -- .tar shard, its index must be at path + '.idx'
+        """
+        self.path = path
+        with open(path + '.idx') as file:
+            self.index = json.load(file)
+        self._file = open(path, 'rb')
+        self._lock = threading.Lock()
+    
+    
+    def keys(self):
+        return list(self.index)
+    
+    
+    def __len__(self):
+        return len(self.index)
+    
+    
+    def __getitem__(self, key:str):
+        """Return the record key as a dict extension -> bytes (json files are decoded)"""
+        record = {}
+        for extension, (offset, size) in self.index[key].items():
+            with self._lock:
+                self._file.seek(offset)
+                data = self._file.read(size)
+            record[extension] = json.loads(data) if extension == 'json' else data
+        return record
+    
+    
+    def close(self):
+        self._file.close()
+
+
+def export_shards(directory:str, style:str = 'geometric', n:int = 1000, img_size:tuple = (600,400), seed = None,
+                  format:str = 'jpeg', prefix:str = None, max_bytes:int = 256*2**20, encode_workers:int = 2):
+    """Render n artworks into tar shards (see ShardWriter), each image with a json sidecar, returns the manifest
+    * The sidecar has the seed and the options chosen by the style (see render_batch_array), the key of
+    image i is its index with 9 digits, the seeds are spawned from seed as in generate_batch
+    * Encoding runs on a thread pool while the next images are rendered, the shards are written in order
+    
+    Keyword arguments:
+    directory -- folder of the shards
+    style -- name of a style in ART_STYLES
+    n -- number of images
+    img_size -- 2-d tuple with (x,y) in pixels
+    seed -- seed used to spawn one seed per image (default random)
+    format -- 'jpeg', 'png' or 'webp'
+    prefix -- name of the shards (default style)
+    max_bytes -- max size of a shard
+    encode_workers -- number of threads encoding images
+    """
+    
+    if style not in ART_STYLES:
+        raise Exception('style must be ' + ' or '.join(ART_STYLES))
+    seed_seq = np.random.SeedSequence(seed)
+    pending = deque()
+    with ShardWriter(directory, prefix or style, max_bytes) as writer, \
+         ThreadPoolExecutor(max_workers = encode_workers) as executor:
+        
+        def write_oldest():
+            metadata, future = pending.popleft()
+            writer.write(str(metadata['index']).zfill(9), {format: future.result()['data'], 'json': metadata})
+        
+        for i in range(n):
+            img, metadata = _render_with_metadata(style, img_size, seed_seq.spawn(1)[0], i)
+            metadata['format'] = format
+            pending.append((metadata, executor.submit(encode_image, img, format)))
+            del img
+            if len(pending) > 2*encode_workers:
+                write_oldest()
+        while pending:
+            write_oldest()
+    return writer.manifest
+
+
+class JobQueue():
+    """A resumable queue of generation jobs stored in a SQLite file, shared by any number of worker processes
+    * A job (style mix, count, img_size, seed) is split into work units of unit_size images, workers lease a unit,
+    render it, renew the lease with heartbeats and mark it as done (see run_worker)
+    * A unit whose lease expired (crashed or stopped worker) is leased again by the next worker, so an interrupted
+    run loses at most the units that were being rendered, and throughput grows by adding workers
+    * Image i of a job is rendered with np.random.SeedSequence(seed, spawn_key = (i,)), the same seed as
+    generate_batch with base_seed seed, so a unit rendered twice gives the same images
+    * Workers on several hosts can share the file if the filesystem supports SQLite (POSIX) locks, the database
+    uses the rollback journal for that. Leases use the wall clock
+    so the clocks of the hosts must agree within a small part of lease_seconds
+    """
+    
+    
+    def __init__(self, path:str = 'jobs.sqlite', timeout:float = 60):
+        """Keyword arguments:
+        path -- SQLite database file, created if it doesn't exist
+        timeout -- seconds to wait for the lock held by another worker
+        """
+        import sqlite3
+        self.path = path
+        self._lock = threading.Lock()
+        # Autocommit mode, the transactions that need it are opened explicitly
+        self._connection = sqlite3.connect(path, timeout = timeout, isolation_level = None, check_same_thread = False)
+        with self._lock:
+            # Rollback journal, WAL needs shared memory and only works with every process on the same host
+            self._connection.execute('PRAGMA journal_mode = DELETE')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, manifest TEXT NOT NULL)')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS units (job INTEGER NOT NULL, unit INTEGER NOT NULL, '
+                                     'style TEXT NOT NULL, first INTEGER NOT NULL, count INTEGER NOT NULL, '
+                                     "state TEXT NOT NULL DEFAULT 'pending', worker TEXT, lease_until REAL, "
+                                     'attempts INTEGER NOT NULL DEFAULT 0, shard TEXT, PRIMARY KEY (job, unit))')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS units_state ON units (state, lease_until)')
+    
+    
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Write transaction, the database is locked from its start so two workers never lease the same unit"""
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._connection
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+            self._connection.execute('COMMIT')
+    
+    
+    def submit(self, styles, count:int, img_size:tuple = (600,400), seed = None, out_dir:str = 'jobs',
+               unit_size:int = 1000):
+        """Add a job and return its id
+        * Images are split between the styles in contiguous index ranges proportional to their weights,
+        a unit never mixes styles
+        
+        Keyword arguments:
+        styles -- style name or dict style -> weight, ex: {'chaotic': 0.3, 'geometric': 0.7}
+        count -- number of images
+        img_size -- 2-d tuple with (x,y) in pixels
+        seed -- int base seed (default random)
+        out_dir -- folder of the shards, one shard per unit named <job>-<unit>-a<attempt>-000000.tar (see ShardWriter)
+        unit_size -- images per work unit, the most work lost if a worker crashes
+        """
+        if isinstance(styles, str):
+            styles = {styles: 1}
+        for style in styles:
+            if style not in ART_STYLES:
+                raise Exception('style must be ' + ' or '.join(ART_STYLES))
+        if seed == None:
+            seed = np.random.SeedSequence().entropy
+        manifest = {'styles': styles, 'count': count, 'img_size': list(img_size), 'seed': int(seed),
+                    'out_dir': out_dir, 'unit_size': unit_size}
+        
+        # Index range of each style, the last style takes the rounding leftovers
+        total, first, units = sum(styles.values()), 0, []
+        for k, (style, weight) in enumerate(styles.items()):
+            last = count if k == len(styles) - 1 else min(count, first + round(count*weight/total))
+            for start in range(first, last, unit_size):
+                units.append((style, start, min(unit_size, last - start)))
+            first = last
+        
+        with self._transaction() as connection:
+            job = connection.execute('INSERT INTO jobs (manifest) VALUES (?)', (json.dumps(manifest),)).lastrowid
+            connection.executemany('INSERT INTO units (job, unit, style, first, count) VALUES (?,?,?,?,?)',
+                                   [(job, unit) + values for unit, values in enumerate(units)])
+        return job
+    
+    
+    def manifest(self, job:int):
+        with self._lock:
+            row = self._connection.execute('SELECT manifest FROM jobs WHERE id = ?', (job,)).fetchone()
+        if row == None:
+            raise Exception('job ' + str(job) + ' does not exist')
+        return json.loads(row[0])
+    
+    
+    def claim(self, worker:str, lease_seconds:float = 120, job:int = None):
+        """Lease the next pending (or expired) unit to worker, returns the unit as a dict or None if there is none
+        * The dict has the number of the lease in 'attempts', each lease of a unit writes to its own shard prefix
+        
+        Keyword arguments:
+        worker -- unique name of the worker
+        lease_seconds -- the unit is given to another worker if no heartbeat comes in this time
+        job -- lease only units of this job (default any job, oldest first)
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            row = connection.execute("SELECT job, unit, style, first, count, attempts + 1 FROM units WHERE (state = 'pending' OR "
+                                     "(state = 'leased' AND lease_until < ?)) AND (? IS NULL OR job = ?) "
+                                     'ORDER BY job, unit LIMIT 1', (now, job, job)).fetchone()
+            if row == None:
+                return None
+            connection.execute("UPDATE units SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                               'WHERE job = ? AND unit = ?', (worker, now + lease_seconds, row[0], row[1]))
+        return dict(zip(['job', 'unit', 'style', 'first', 'count', 'attempts'], row))
+    
+    
+    def heartbeat(self, unit:dict, worker:str, lease_seconds:float = 120):
+        """Renew the lease of unit, returns False if worker lost it (expired and leased by another worker)"""
+        with self._transaction() as connection:
+            changed = connection.execute("UPDATE units SET lease_until = ? WHERE job = ? AND unit = ? AND worker = ? "
+                                         "AND state = 'leased'",
+                                         (time.time() + lease_seconds, unit['job'], unit['unit'], worker)).rowcount
+        return changed == 1
+    
+    
+    def complete(self, unit:dict, worker:str, shard:str = None):
+        """Mark unit as done, returns False if worker lost its lease (the unit stays with the new worker)
+        
+        Keyword arguments:
+        unit -- unit returned by claim
+        worker -- name of the worker holding the lease
+        shard -- ShardWriter prefix holding the images of the unit, recorded in the same transaction (see shards)
+        """
+        with self._transaction() as connection:
+            changed = connection.execute("UPDATE units SET state = 'done', lease_until = NULL, shard = ? WHERE job = ? "
+                                         "AND unit = ? AND worker = ? AND state = 'leased'",
+                                         (shard, unit['job'], unit['unit'], worker)).rowcount
+        return changed == 1
+    
+    
+    def shards(self, job:int):
+        """Return the paths of the .tar shards of the done units of job, in unit order
+        * Only the shards of the lease that completed each unit are listed, files left by other leases are ignored
+        """
+        out_dir = self.manifest(job)['out_dir']
+        with self._lock:
+            rows = self._connection.execute("SELECT shard FROM units WHERE job = ? AND state = 'done' ORDER BY unit",
+                                            (job,)).fetchall()
+        paths = []
+        for (prefix,) in rows:
+            with open(os.path.join(out_dir, prefix + '-manifest.json')) as file:
+                paths += [os.path.join(out_dir, shard['path']) for shard in json.load(file)['shards']]
+        return paths
+    
+    
+    def progress(self, job:int = None):
+        """Return the number of units and images in each state ('pending', 'leased', 'expired', 'done')"""
+        with self._lock:
+            rows = self._connection.execute("SELECT CASE WHEN state = 'leased' AND lease_until < ? THEN 'expired' "
+                                            'ELSE state END, COUNT(*), SUM(count) FROM units WHERE ? IS NULL OR job = ? '
+                                            'GROUP BY 1', (time.time(), job, job)).fetchall()
+        progress = {state: {'units': 0, 'images': 0} for state in ['pending', 'leased', 'expired', 'done']}
+        for state, units, images in rows:
+            progress[state] = {'units': units, 'images': images}
+        return progress
+    
+    
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def _render_unit(jobs:JobQueue, unit:dict, worker:str, lease_seconds:float):
+    """Render the images of a leased unit into its shard, heartbeats are sent by a background thread
+    * Each lease writes to its own prefix <job>-<unit>-a<attempt>, so a worker that lost its lease never
+    touches the files of the worker now holding the unit
+    * The lease is renewed right before the shard is renamed into place and the unit is completed with it,
+    if the lease was lost in between the published files are removed again
+    * Returns True if the unit was completed, False if the lease was lost
+    """
+    manifest = jobs.manifest(unit['job'])
+    out_dir = manifest['out_dir']
+    unit_prefix = str(unit['job']) + '-' + str(unit['unit']).zfill(6) + '-a'
+    prefix = unit_prefix + str(unit['attempts']).zfill(3)
+    
+    def remove_shards(own:bool):
+        """Remove the files of this lease (own=True) or of the other leases of the unit (own=False)"""
+        for name in os.listdir(out_dir):
+            if name.startswith(unit_prefix) and name.startswith(prefix + '-') == own:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(out_dir, name))
+    
+    lost = threading.Event()
+    done = threading.Event()
+    
+    def beat():
+        while not done.wait(lease_seconds/3):
+            if not jobs.heartbeat(unit, worker, lease_seconds):
+                lost.set()
+                return
+    
+    thread = threading.Thread(target = beat, daemon = True)
+    thread.start()
+    try:
+        writer = ShardWriter(out_dir, prefix, max_bytes = 2**40)
+        for i in range(unit['first'], unit['first'] + unit['count']):
+            if lost.is_set():
+                writer.abort()
+                return False
+            img, metadata = _render_with_metadata(unit['style'], manifest['img_size'],
+                                                  np.random.SeedSequence(manifest['seed'], spawn_key = (i,)), i)
+            metadata['job'] = unit['job']
+            writer.write(str(i).zfill(9), {'jpeg': encode_image(img)['data'], 'json': metadata})
+        # Publish only while holding the lease, renewed so that it can't expire before complete
+        if lost.is_set() or not jobs.heartbeat(unit, worker, lease_seconds):
+            writer.abort()
+            return False
+        writer.close()
+    finally:
+        done.set()
+        thread.join()
+    if not jobs.complete(unit, worker, prefix):
+        remove_shards(own = True)
+        return False
+    # Leftovers of the leases that expired before this one
+    remove_shards(own = False)
+    return True
+
+
+def run_worker(path:str = 'jobs.sqlite', worker:str = None, lease_seconds:float = 120, job:int = None,
+               max_units:int = None):
+    """Lease and render units from the JobQueue at path until there are none left, returns the units completed
+    * Start as many workers as wanted (processes, hosts sharing path and the output folder), each unit is
+    written to its own shard and finished atomically, a unit whose worker crashed is rendered again by another one
+    * The shards of the finished units are listed by JobQueue.shards
+    
+    Keyword arguments:
+    path -- JobQueue SQLite file
+    worker -- unique name of this worker (default hostname-pid)
+    lease_seconds -- time without heartbeat after which a unit is given to another worker
+    job -- render only this job (default all jobs)
+    max_units -- stop after this number of units (default None, until the queue is empty)
+    """
+    import socket
+    if worker == None:
+        worker = socket.gethostname() + '-' + str(os.getpid())
+    jobs = JobQueue(path)
+    completed = 0
+    try:
+        while max_units == None or completed < max_units:
+            unit = jobs.claim(worker, lease_seconds, job)
+            if unit == None:
+                break
+            if _render_unit(jobs, unit, worker, lease_seconds):
+                completed += 1
+    finally:
+        jobs.close()
+    return completed
@@ -0,0 +1,91 @@
+"""Command line interface of ArtGenerator, ex: python artgen.py chaotic -n 100 --size 1920x1080 --seed 42 --out dir/
+* Only the standard library modules needed to parse the arguments are imported at start, ArtGenerator
+(and with it NumPy and Pillow) is imported only when images are rendered
+* --dry-run lists the files and the seed of each image without importing NumPy (only the base seed is
+random, the seed of image i is derived from it), within START_BUDGET seconds. The style choices of
+each image are drawn by NumPy when it is rendered, a dry run doesn't know them
+* The images and seeds are the same as generate_batch / iter_art with base seed --seed
+"""
+
+import argparse
+import os
+import sys
+
+# Styles accepted, the same as ArtGenerator.ART_STYLES (styles registered by scripts don't exist in a new process)
+STYLES = ['chaotic', 'geometric']
+
+# Max cold start (seconds) of --help and --dry-run on top of the Python interpreter start, see benchmark.py
+START_BUDGET = 0.05
+
+
+def _parse_size(value:str):
+    """Parse WIDTHxHEIGHT, both positive"""
+    try:
+        width, height = value.lower().split('x')
+        width, height = int(width), int(height)
+    except ValueError:
+        raise argparse.ArgumentTypeError('size must be WIDTHxHEIGHT, ex: 1920x1080')
+    if width < 1 or height < 1:
+        raise argparse.ArgumentTypeError('width and height must be positive')
+    return width, height
+
+
+def _parse_seed(value:str):
+    """Parse a non-negative int seed (NumPy rejects negative seeds)"""
+    try:
+        seed = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('seed must be an integer')
+    if seed < 0:
+        raise argparse.ArgumentTypeError('seed must be non-negative')
+    return seed
+
+
+def image_seeds(n:int, seed:int = None):
+    """Return (entropy, [(entropy, spawn_key) for each image]) without NumPy
+    * Image i is rendered with np.random.SeedSequence(entropy, spawn_key = (i,)), the same seed as
+    np.random.SeedSequence(entropy).spawn(n)[i] used by generate_batch and iter_art
+
+    Keyword arguments:
+    n -- number of images
+    seed -- base seed (default 128 random bits, like np.random.SeedSequence())
+    """
+    if seed == None:
+        import secrets
+        seed = secrets.randbits(128)
+    return seed, [(seed, (i,)) for i in range(n)]
+
+
+def main(argv:list = None):
+    parser = argparse.ArgumentParser(prog = 'artgen', description = 'Create random artworks')
+    parser.add_argument('style', choices = STYLES)
+    parser.add_argument('-n', type = int, default = 1, help = 'number of images (default 1)')
+    parser.add_argument('--size', type = _parse_size, default = (600,400), help = 'WIDTHxHEIGHT (default 600x400)')
+    parser.add_argument('--seed', type = _parse_seed, default = None, help = 'non-negative base seed (default random)')
+    parser.add_argument('--out', default = '.', help = 'output folder, images are saved as <style>_<index>.jpeg')
+    parser.add_argument('--workers', type = int, default = 1,
+                        help = 'number of processes, 1 renders in this process (default 1)')
+    parser.add_argument('--dry-run', action = 'store_true', help = 'print the files and seeds, render nothing')
+    parser.add_argument('--quiet', action = 'store_true', help = "don't print the paths")
+    args = parser.parse_args(argv)
+
+    entropy, seeds = image_seeds(args.n, args.seed)
+    paths = [os.path.join(args.out, args.style + '_' + str(i) + '.jpeg') for i in range(args.n)]
+    if args.dry_run:
+        for path, (seed, spawn_key) in zip(paths, seeds):
+            print(path, seed, spawn_key[0])
+        return 0
+
+    import ArtGenerator
+    if args.workers == 1:
+        paths = ArtGenerator.iter_art(args.style, args.n, args.size, entropy, out_dir = args.out)
+    else:
+        paths = ArtGenerator.generate_batch(args.style, args.n, args.size, args.workers, entropy, out_dir = args.out)
+    for path in paths:
+        if not args.quiet:
+            print(path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,196 @@
+"""Benchmark of every ArtGenerator method and of both art styles
+* Every run uses fixed seeds, so two runs of the same version render exactly the same images
+* Reports latency distributions (seconds), images per second and peak RSS for each image size,
+each size runs in its own process so its peak RSS is not mixed with the other sizes
+* Results are saved as json, ex: python benchmark.py --repeat 20 --out results.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import PIL
+
+from ArtGenerator import ArtGenerator, create_chaotic_art, create_geometric_art
+import artgen
+
+# Image sizes tested by default, name -> (x,y)
+SIZES = {'600x400': (600,400), '1920x1080': (1920,1080), '4K': (3840,2160)}
+
+# Methods tested, name -> function(ArtGenerator object, temporary directory)
+METHODS = {
+    'alter_background': lambda im, tmp: im.alter_background(),
+    'add_curve_effect': lambda im, tmp: im.add_curve_effect(),
+    'draw_vertical_lines': lambda im, tmp: im.draw_vertical_lines(),
+    'draw_horizontal_lines': lambda im, tmp: im.draw_horizontal_lines(),
+    'draw_diagonal_lines': lambda im, tmp: im.draw_diagonal_lines(),
+    'draw_regular_polygon': lambda im, tmp: im.draw_regular_polygon(),
+    'draw_artistic_polygon': lambda im, tmp: im.draw_artistic_polygon(),
+    'draw_line': lambda im, tmp: im.draw_line(random_qnt_lines = True, width = 3),
+    'draw_arc': lambda im, tmp: im.draw_arc(),
+    'draw_ellipse': lambda im, tmp: im.draw_ellipse(),
+    'draw_points': lambda im, tmp: im.draw_points(),
+    'smooth_lines': lambda im, tmp: im.smooth_lines(),
+    'encode': lambda im, tmp: im.encode(),
+    'save_img': lambda im, tmp: im.save_img(directory = tmp),
+}
+
+# End-to-end pipelines tested, name -> function(img_size, seed)
+PIPELINES = {
+    'create_chaotic_art': lambda img_size, seed: create_chaotic_art(img_size = img_size, seed = seed),
+    'create_geometric_art': lambda img_size, seed: create_geometric_art(img_size = img_size, seed = seed),
+}
+
+
+def _distribution(times:list):
+    """Return the summary of a list of latencies in seconds"""
+    times = np.array(times)
+    return {'runs': len(times),
+            'mean': float(times.mean()),
+            'min': float(times.min()),
+            'p50': float(np.percentile(times, 50)),
+            'p90': float(np.percentile(times, 90)),
+            'p99': float(np.percentile(times, 99)),
+            'max': float(times.max())}
+
+
+def _peak_rss():
+    """Return the peak resident memory of this process in bytes (None if unavailable)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kB, macOS bytes
+    return peak if sys.platform == 'darwin' else peak*1024
+
+
+def bench_size(img_size:tuple, repeat:int = 20, seed:int = 0):
+    """Return the results of all methods and pipelines at img_size
+
+    Keyword arguments:
+    img_size -- 2-d tuple with (x,y) in pixels
+    repeat -- number of runs of each method / pipeline
+    seed -- base seed, run i uses seed + i
+    """
+
+    results = {'methods': {}, 'pipelines': {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, method in METHODS.items():
+            times = []
+            for i in range(repeat):
+                # The object is created outside of the timed region
+                im = ArtGenerator(bg_type = 'light', img_size = img_size, seed = seed + i)
+                start = time.perf_counter()
+                method(im, tmp)
+                times.append(time.perf_counter() - start)
+            results['methods'][name] = _distribution(times)
+
+    for name, pipeline in PIPELINES.items():
+        times = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            pipeline(img_size, seed + i)
+            times.append(time.perf_counter() - start)
+        results['pipelines'][name] = _distribution(times)
+        results['pipelines'][name]['images_per_second'] = repeat/sum(times)
+
+    results['peak_rss'] = _peak_rss()
+    return results
+
+
+def bench_cli_start(repeat:int = 20):
+    """Return the cold start of the command line interface (seconds), each run is a new Python process
+    * 'python' is the interpreter alone, 'dry_run' runs artgen --dry-run (no NumPy import) and 'render'
+    renders one 64x64 image, overhead (dry_run p50 - python p50) must stay under artgen.START_BUDGET
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'artgen.py')
+    commands = {'python': [sys.executable, '-c', 'pass'],
+                'dry_run': [sys.executable, script, 'geometric', '-n', '10', '--seed', '0', '--dry-run'],
+                'render': [sys.executable, script, 'geometric', '--size', '64x64', '--seed', '0', '--quiet']}
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        commands['render'] += ['--out', tmp]
+        for name, command in commands.items():
+            times = []
+            for i in range(repeat):
+                start = time.perf_counter()
+                subprocess.run(command, check = True, stdout = subprocess.DEVNULL)
+                times.append(time.perf_counter() - start)
+            results[name] = _distribution(times)
+    results['overhead'] = results['dry_run']['p50'] - results['python']['p50']
+    results['budget'] = artgen.START_BUDGET
+    results['within_budget'] = results['overhead'] <= artgen.START_BUDGET
+    return results
+
+
+def run(sizes:dict = SIZES, repeat:int = 20, seed:int = 0):
+    """Return the benchmark results of every size, each size is measured in a new process
+
+    Keyword arguments:
+    sizes -- dict name -> (x,y)
+    repeat -- number of runs of each method / pipeline
+    seed -- base seed
+    """
+
+    results = {'python': platform.python_version(),
+               'numpy': np.__version__,
+               'pillow': PIL.__version__,
+               'platform': platform.platform(),
+               'cpu_count': os.cpu_count(),
+               'repeat': repeat,
+               'seed': seed,
+               'sizes': {}}
+    results['cli_start'] = bench_cli_start(repeat)
+    context = multiprocessing.get_context('spawn')
+    for name, img_size in sizes.items():
+        with context.Pool(1) as pool:
+            results['sizes'][name] = pool.apply(bench_size, (img_size, repeat, seed))
+        results['sizes'][name]['img_size'] = list(img_size)
+    return results
+
+
+def _parse_size(value:str):
+    """Parse WIDTHxHEIGHT or one of the SIZES names"""
+    if value in SIZES:
+        return value, SIZES[value]
+    width, height = value.lower().split('x')
+    return value, (int(width), int(height))
+
+
+def main(argv:list = None):
+    parser = argparse.ArgumentParser(description = 'Benchmark ArtGenerator methods and art styles')
+    parser.add_argument('--sizes', nargs = '+', type = _parse_size, default = list(SIZES.items()),
+                        help = 'WIDTHxHEIGHT or ' + ', '.join(SIZES) + ' (default all)')
+    parser.add_argument('--repeat', type = int, default = 20, help = 'runs of each method / pipeline')
+    parser.add_argument('--seed', type = int, default = 0, help = 'base seed')
+    parser.add_argument('--out', default = 'benchmark_results.json', help = 'json output path')
+    args = parser.parse_args(argv)
+
+    results = run(dict(args.sizes), args.repeat, args.seed)
+    with open(args.out, 'w') as file:
+        json.dump(results, file, indent = 2)
+
+    cli = results['cli_start']
+    print('artgen cold start p50 {:.3f}s, dry-run overhead {:.3f}s (budget {}s), render {:.3f}s'.format(
+          cli['dry_run']['p50'], cli['overhead'], cli['budget'], cli['render']['p50']))
+    for name, size_results in results['sizes'].items():
+        print(name, 'peak RSS', round((size_results['peak_rss'] or 0)/2**20), 'MB')
+        for group in ['methods', 'pipelines']:
+            for method, stats in size_results[group].items():
+                line = '  {:<24} p50 {:9.5f}s  p99 {:9.5f}s'.format(method, stats['p50'], stats['p99'])
+                if 'images_per_second' in stats:
+                    line += '  {:8.2f} img/s'.format(stats['images_per_second'])
+                print(line)
+    print('Saved', args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""Tests of ArtGenerator, run with python -m pytest"""
+
+import io
+import time
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+import ArtGenerator
+from ArtGenerator import ArtGenerator as Generator
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_numpy_line_backend_matches_pil(seed):
+    images = []
+    for backend in ['pil', 'numpy']:
+        im = Generator(seed = seed, img_size = (640,360), line_backend = backend)
+        im.alter_background()
+        im.add_curve_effect()
+        im.draw_vertical_lines()
+        im.draw_horizontal_lines()
+        im.draw_diagonal_lines()
+        images.append(im.img.tobytes())
+    assert images[0] == images[1]
+
+
+def test_rasterize_lines_matches_imagedraw_on_clipped_segments():
+    rng = np.random.default_rng(0)
+    lines = rng.integers(-300, 500, (500, 4)).tolist()
+    img = Image.new('RGB', (200,150))
+    draw = ImageDraw.Draw(img)
+    for line in lines:
+        draw.line(line, fill = (255,255,255), width = 1)
+    expected = np.array(img)[:, :, 0] > 0
+    x, y = ArtGenerator._rasterize_lines(lines, img.size)
+    result = np.zeros_like(expected)
+    result[y, x] = True
+    assert (result == expected).all()
+
+
+@pytest.mark.parametrize('img_size,blur_factor', [((640,360), 0.5), ((301,97), 2), ((50,9), 3.7), ((4,3), 1)])
+def test_fused_smoothing_close_to_pil(img_size, blur_factor):
+    base = ArtGenerator.create_geometric_art(img_size = img_size, seed = 1)
+    expected = np.asarray(ArtGenerator._smooth(base.copy(), blur_factor, 'pil'), dtype = np.int16)
+    result = np.asarray(ArtGenerator._smooth(base.copy(), blur_factor, 'numpy'), dtype = np.int16)
+    assert np.abs(result - expected).max() <= 2
+
+
+@pytest.mark.parametrize('quality', ['draft', 'final'])
+def test_encode_renders_recorded_tiers(quality):
+    im = Generator(bg_type = 'white', img_size = (200,100), seed = 3, quality = quality)
+    im.alter_background()
+    im.draw_ellipse()
+    data = im.encode('png')['data']
+    expected = io.BytesIO()
+    im.render().save(expected, format = 'png')
+    assert Image.open(io.BytesIO(data)).tobytes() == Image.open(expected).tobytes()
+    assert len(Image.open(io.BytesIO(data)).getcolors(2**16)) > 1
+
+
+def test_serve_art_rejects_bad_queries():
+    import socket, threading, urllib.error, urllib.request
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    pool = ArtGenerator.ArtPool(sizes = [(64,64)], pool_size = 1)
+    threading.Thread(target = ArtGenerator.serve_art, kwargs = {'port': port, 'pool': pool}, daemon = True).start()
+    url = 'http://127.0.0.1:' + str(port)
+    for attempt in range(50):
+        try:
+            urllib.request.urlopen(url + '/stats')
+            break
+        except urllib.error.URLError:
+            time.sleep(0.1)
+    
+    with pytest.raises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen(url + '/art/geometric?seed=-1&w=64&h=64')
+    assert error.value.code == 400
+    pool.get = lambda *args: 1/0
+    with pytest.raises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen(url + '/art/geometric?seed=1&w=64&h=64')
+    assert error.value.code == 500
+
+
+def test_tracer_memory_sees_pillow_buffers():
+    tracer = ArtGenerator.Tracer(memory = True)
+    im = Generator(seed = 1, img_size = (640,360), tracer = tracer)
+    im.smooth_lines()
+    span = tracer.spans[-1]
+    # SMOOTH_MORE and BoxBlur each return a new image
+    assert span['name'] == 'smooth_lines' and span['pillow_blocks'] >= 2
+    if ArtGenerator._peak_memory() != None:
+        assert span['peak_rss_bytes'] >= 0
+
+
+class _WriterRecorder(ArtGenerator.AnimationRecorder):
+    """Always uses Pillow's webp writer"""
+    def _webp_encoder(self, first):
+        return None
+
+
+def _record(recorder_class, **options):
+    output = io.BytesIO()
+    with recorder_class(output, 'webp', **options) as recorder:
+        ArtGenerator.create_geometric_art(img_size = (160,100), seed = 4, animation = recorder)
+    return output.getvalue()
+
+
+@pytest.mark.parametrize('options', [{}, {'quality': 50, 'method': 6}, {'lossless': True}])
+def test_webp_frame_by_frame_matches_pillow_writer(options):
+    assert _record(ArtGenerator.AnimationRecorder, **options) == _record(_WriterRecorder, **options)
+
+
+def test_webp_falls_back_when_the_private_encoder_changes(monkeypatch):
+    from PIL import _webp
+    expected = _record(_WriterRecorder)
+    monkeypatch.setattr(_webp, 'WebPAnimEncoder', lambda *args: (_ for _ in ()).throw(TypeError('signature')))
+    assert _record(ArtGenerator.AnimationRecorder) == expected
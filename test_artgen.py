@@ -0,0 +1,18 @@
+"""Tests of the artgen command line, run with python -m pytest"""
+
+import pytest
+
+import artgen
+
+
+@pytest.mark.parametrize('argv', [['geometric', '--size', '0x10'], ['geometric', '--size', '10x-1'],
+                                  ['geometric', '--seed', '-1'], ['geometric', '--seed', '-1', '--dry-run']])
+def test_invalid_arguments_are_rejected_by_argparse(argv):
+    with pytest.raises(SystemExit) as error:
+        artgen.main(argv)
+    assert error.value.code == 2
+
+
+def test_dry_run_seeds(capsys):
+    assert artgen.main(['chaotic', '-n', '2', '--seed', '7', '--dry-run', '--out', 'out']) == 0
+    assert capsys.readouterr().out.split('\n')[:2] == ['out/chaotic_0.jpeg 7 0', 'out/chaotic_1.jpeg 7 1']